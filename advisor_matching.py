@@ -0,0 +1,185 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from embedding_store import load_embedding_store, load_guids, current_snapshot, metadata_path, MetadataColumns
+from recommendation_engine import ExactIndex, guids_at
+
+MATCH_METHODS = ('stable', 'greedy')
+
+
+def top_k_graph(query_embeddings, candidate_embeddings, top_k, block_size=1024, candidate_block_size=65536):
+    # Top-k candidate rows and scores for every query row, (n, k) each: this and the edge list
+    # built from it are all the matching keeps, never the dense n x m score matrix.
+    width = min(top_k, len(candidate_embeddings))
+    indices = np.empty((len(query_embeddings), width), dtype=np.int32)
+    scores = np.empty((len(query_embeddings), width), dtype=np.float32)
+    index = ExactIndex(candidate_embeddings)
+    for start in range(0, len(query_embeddings), block_size):
+        queries = np.asarray(query_embeddings[start:start + block_size])
+        matches = index.search_batch(queries, width, block_size=len(queries), candidate_block_size=candidate_block_size)
+        indices[start:start + len(queries)] = np.stack([rows for rows, _ in matches])
+        scores[start:start + len(queries)] = np.stack([sim_scores for _, sim_scores in matches])
+    return indices, scores
+
+
+def bipartite_edges(student_indices, student_scores, professor_indices, professor_scores, n_professors,
+                    reciprocal=False, min_score=None):
+    # Student -> professor edges from both top-k lists, as (student, professor, score) arrays.
+    # reciprocal keeps only pairs that appear in each other's lists.
+    forward = np.repeat(np.arange(len(student_indices), dtype=np.int64), student_indices.shape[1]) * n_professors + student_indices.ravel()
+    backward = (professor_indices.ravel().astype(np.int64) * n_professors +
+                np.repeat(np.arange(len(professor_indices), dtype=np.int64), professor_indices.shape[1]))
+    if reciprocal:
+        keys, positions, _ = np.intersect1d(forward, backward, assume_unique=True, return_indices=True)
+        scores = student_scores.ravel()[positions]
+    else:
+        keys, positions = np.unique(np.concatenate([forward, backward]), return_index=True)
+        scores = np.concatenate([student_scores.ravel(), professor_scores.ravel()])[positions]
+
+    if min_score is not None:
+        keep = scores > min_score
+        keys, scores = keys[keep], scores[keep]
+    return keys // n_professors, keys % n_professors, scores
+
+
+def stable_match(students, professors, scores, n_students, capacities):
+    # Student-proposing deferred acceptance with professor capacities, run in vectorized rounds:
+    # every free student proposes to its best professor not yet tried, and each professor keeps
+    # its capacity's worth of best-scoring proposals (held ones included) and rejects the rest.
+    # Both sides rank by the same cosine score, so the result is the unique stable matching of
+    # the graph up to ties, which are broken towards lower rows.
+    order = np.lexsort((professors, -scores, students))
+    edge_professors, edge_scores = professors[order], scores[order]
+    degrees = np.bincount(students, minlength=n_students)
+    offsets = np.concatenate([[0], np.cumsum(degrees)])[:-1]
+    tried = np.zeros(n_students, dtype=np.int64)
+
+    held_students = np.empty(0, dtype=np.int64)
+    held_professors = np.empty(0, dtype=np.int64)
+    held_scores = np.empty(0, dtype=scores.dtype)
+    free = np.flatnonzero(degrees)
+    while len(free):
+        free = free[tried[free] < degrees[free]]
+        if not len(free):
+            break
+        edges = offsets[free] + tried[free]
+        tried[free] += 1
+
+        candidate_students = np.concatenate([held_students, free])
+        candidate_professors = np.concatenate([held_professors, edge_professors[edges]])
+        candidate_scores = np.concatenate([held_scores, edge_scores[edges]])
+        ranked = np.lexsort((candidate_students, -candidate_scores, candidate_professors))
+        ranked_professors = candidate_professors[ranked]
+        group_starts = np.searchsorted(ranked_professors, ranked_professors, side='left')
+        keep = np.zeros(len(ranked), dtype=bool)
+        keep[ranked] = np.arange(len(ranked)) - group_starts < capacities[ranked_professors]
+
+        held_students, held_professors, held_scores = candidate_students[keep], candidate_professors[keep], candidate_scores[keep]
+        free = candidate_students[~keep]
+
+    order = np.argsort(held_students)
+    return held_students[order], held_professors[order], held_scores[order]
+
+
+def greedy_match(students, professors, scores, n_students, capacities):
+    # Takes edges best score first while both ends have room. With symmetric scores this
+    # reaches the same assignment as stable_match, one edge at a time.
+    remaining = np.array(capacities, dtype=np.int64)
+    matched = np.zeros(n_students, dtype=bool)
+    unmatched = n_students
+    selected = []
+    for edge in np.lexsort((professors, students, -scores)).tolist():
+        student, professor = students[edge], professors[edge]
+        if matched[student] or remaining[professor] == 0:
+            continue
+        matched[student] = True
+        remaining[professor] -= 1
+        selected.append(edge)
+        unmatched -= 1
+        if not unmatched:
+            break
+
+    selected = np.asarray(selected, dtype=np.int64)
+    selected = selected[np.argsort(students[selected])]
+    return students[selected], professors[selected], scores[selected]
+
+
+def professor_capacities(capacity, n_students, n_professors):
+    # An int for every professor, a per-professor array, or None for just enough seats for everyone.
+    if capacity is None:
+        capacity = -(-n_students // max(n_professors, 1))
+    capacities = np.broadcast_to(np.asarray(capacity, dtype=np.int64), (n_professors,))
+    if (capacities < 0).any():
+        raise ValueError("Professor capacities must not be negative")
+    return capacities
+
+
+def match_students_to_professors(student_embeddings, professor_embeddings, capacity=None, top_k=20, method='stable',
+                                 reciprocal=False, min_score=None, block_size=1024, candidate_block_size=65536):
+    # Takes the normalized matrices and returns (student rows, professor rows, scores) of the
+    # assignment, one row per matched student. Memory is O((students + professors) * top_k).
+    if method not in MATCH_METHODS:
+        raise ValueError(f"Unknown matching method {method}, expected one of {MATCH_METHODS}")
+    n_students, n_professors = len(student_embeddings), len(professor_embeddings)
+    capacities = professor_capacities(capacity, n_students, n_professors)
+    if not n_students or not n_professors:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    student_indices, student_scores = top_k_graph(student_embeddings, professor_embeddings, top_k, block_size, candidate_block_size)
+    professor_indices, professor_scores = top_k_graph(professor_embeddings, student_embeddings, top_k, block_size, candidate_block_size)
+    students, professors, scores = bipartite_edges(student_indices, student_scores, professor_indices, professor_scores,
+                                                   n_professors, reciprocal, min_score)
+    del student_indices, student_scores, professor_indices, professor_scores
+
+    match = stable_match if method == 'stable' else greedy_match
+    return match(students, professors, scores, n_students, capacities)
+
+
+def load_capacities(professor_embeddings_path, column, count):
+    path = metadata_path(professor_embeddings_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} is needed for --capacity-column")
+    metadata = MetadataColumns.load(path)
+    if len(metadata) != count:
+        raise ValueError(f"{path} has {len(metadata)} rows for {count} professors")
+    return metadata[column].astype(np.float64).astype(np.int64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assign students to professors with capacity-constrained matching")
+    parser.add_argument('--data-path', default='./data/recommender_data')
+    parser.add_argument('--top-k', type=int, default=20, help="Candidates kept per student and per professor")
+    parser.add_argument('--capacity', type=int, default=None, help="Students per professor (default: just enough for everyone)")
+    parser.add_argument('--capacity-column', default=None, help="Professor metadata column holding per-professor capacities")
+    parser.add_argument('--method', choices=MATCH_METHODS, default='stable')
+    parser.add_argument('--reciprocal', action='store_true', help="Only match pairs that are in each other's top-k")
+    parser.add_argument('--threshold', type=float, default=None, help="Minimum cosine similarity of a match")
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--candidate-block-size', type=int, default=65536)
+    parser.add_argument('--output', default=None, help="CSV path (default: <data-path>/advisor_matches.csv)")
+    args = parser.parse_args()
+
+    directory = args.data_path
+    if os.path.exists(f'{args.data_path}/snapshots/CURRENT'):
+        directory, _ = current_snapshot(f'{args.data_path}/snapshots')
+
+    start = time.time()
+    _, student_embeddings = load_embedding_store(f'{directory}/student_embeddings.npy')
+    _, professor_embeddings = load_embedding_store(f'{directory}/professor_embeddings.npy')
+    student_guids, _ = load_guids(f'{directory}/student_guids.json')
+    professor_guids, _ = load_guids(f'{directory}/professor_guids.json')
+
+    capacity = args.capacity
+    if args.capacity_column is not None:
+        capacity = load_capacities(f'{directory}/professor_embeddings.npy', args.capacity_column, len(professor_guids))
+
+    students, professors, scores = match_students_to_professors(student_embeddings, professor_embeddings, capacity, args.top_k,
+                                                                args.method, args.reciprocal, args.threshold,
+                                                                args.block_size, args.candidate_block_size)
+    output = args.output or f'{args.data_path}/advisor_matches.csv'
+    pd.DataFrame({'Student GUID': guids_at(student_guids, students), 'Professor GUID': guids_at(professor_guids, professors),
+                  'Similarity Score': scores * 100}).to_csv(output, index=False)
+    print(f"Matched {len(students)} of {len(student_guids)} students to {len(np.unique(professors))} professors "
+          f"in {time.time() - start:.1f} seconds; wrote {output}")
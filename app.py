@@ -1,56 +1,103 @@
+import os
 import streamlit as st
 import numpy as np
 import pandas as pd
 import json
 import time
-from sklearn.metrics.pairwise import cosine_similarity
+import uuid
 from recommendation_engine import ScholarlinkRecommendationEngine
+from embedding_store import current_snapshot
+
+DATA_PATH = './data/recommender_data'
+SNAPSHOT_ROOT = f'{DATA_PATH}/snapshots'
+
+# Recommendation type -> (engine method, result GUID column)
+RECOMMENDATION_TYPES = {
+    'Recommend Professors for Student': ('recommend_professors', 'Professor GUID'),
+    'Recommend Students for Student': ('recommend_students_to_students', 'Student GUID'),
+    'Recommend Students for Professor': ('recommend_students', 'Student GUID'),
+    'Recommend Professors for Professor': ('recommend_professors_to_professors', 'Professor GUID'),
+}
+
+
+def data_version():
+    # Cheap check run on every rerun: the published snapshot version, or the mtimes of the
+    # flat files when no snapshot has been published yet.
+    try:
+        return current_snapshot(SNAPSHOT_ROOT)[1]['version']
+    except FileNotFoundError:
+        return tuple(os.path.getmtime(f'{DATA_PATH}/{name}') for name in
+                     ['student_embeddings.npy', 'professor_embeddings.npy', 'student_guids.json', 'professor_guids.json'])
+
+
+@st.cache_resource(max_entries=1)
+def load_engine(version):
+    # Cached across reruns and sessions; a new version argument rebuilds it.
+    if isinstance(version, int):
+        return ScholarlinkRecommendationEngine.from_snapshots(SNAPSHOT_ROOT)
+
+    student_embeddings_path = f'{DATA_PATH}/student_embeddings.npy'
+    professor_embeddings_path = f'{DATA_PATH}/professor_embeddings.npy'
+    student_guids_path = f'{DATA_PATH}/student_guids.json'
+    professor_guids_path = f'{DATA_PATH}/professor_guids.json'
+
+    return ScholarlinkRecommendationEngine(student_embeddings_path, professor_embeddings_path, 
+                                           student_guids_path, professor_guids_path)
+
+
+def is_guid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
+
+
+def read_guid_column(uploaded_file):
+    # Files may or may not have a header row; a first cell that is not a GUID is taken as one.
+    guids = pd.read_csv(uploaded_file, header=None, dtype=str).iloc[:, 0].fillna('').str.strip().tolist()
+    if guids and not is_guid(guids[0]):
+        guids = guids[1:]
+    return guids
+
+
+def bulk_results(recommender, method, column, guids):
+    results = getattr(recommender, f'{method}_batch')(guids)
+    rows = [(guid, rank, match, score) for guid, recommended_items in zip(guids, results)
+            for rank, (match, score) in enumerate(recommended_items, start=1)]
+    return pd.DataFrame(rows, columns=['Query GUID', 'Rank', column, 'Similarity Score'])
+
 
 def main():
     st.title("Scholarlink Recommendation Engine")
-    
-    student_embeddings_path = './data/recommender_data/student_embeddings.npy'
-    professor_embeddings_path = './data/recommender_data/professor_embeddings.npy'
-    student_guids_path = './data/recommender_data/student_guids.json'
-    professor_guids_path = './data/recommender_data/professor_guids.json'
 
-    recommender = ScholarlinkRecommendationEngine(student_embeddings_path, professor_embeddings_path, 
-                                                  student_guids_path, professor_guids_path)
-    
-    user_input = st.text_input("Enter Student or Professor ID:", "")
-    
-    option = st.selectbox('Select Recommendation Type:', 
-                          ['Recommend Professors for Student', 
-                           'Recommend Students for Student', 
-                           'Recommend Students for Professor',
-                           'Recommend Professors for Professor'])
+    recommender = load_engine(data_version())
     
-    if user_input:
-        start = time.time()
-        
-        if option == 'Recommend Professors for Student':
-            recommended_items = recommender.recommend_professors(user_input)
-            df = pd.DataFrame(recommended_items, columns=['Professor GUID', 'Similarity Score'])
-            st.write(df)
-            st.write(f"Time elapsed: {time.time() - start} seconds")
-            
-        elif option == 'Recommend Students for Student':
-            recommended_items = recommender.recommend_students_to_students(user_input)
-            df = pd.DataFrame(recommended_items, columns=['Student GUID', 'Similarity Score'])
-            st.write(df)
-            st.write(f"Time elapsed: {time.time() - start} seconds")
-            
-        elif option == 'Recommend Students for Professor':
-            recommended_items = recommender.recommend_students(user_input)
-            df = pd.DataFrame(recommended_items, columns=['Student GUID', 'Similarity Score'])
+    option = st.selectbox('Select Recommendation Type:', list(RECOMMENDATION_TYPES))
+    method, column = RECOMMENDATION_TYPES[option]
+
+    mode = st.radio('Mode:', ['Single ID', 'Bulk CSV'], horizontal=True)
+
+    if mode == 'Single ID':
+        user_input = st.text_input("Enter Student or Professor ID:", "")
+
+        if user_input:
+            start = time.time()
+            recommended_items = getattr(recommender, method)(user_input)
+            df = pd.DataFrame(recommended_items, columns=[column, 'Similarity Score'])
             st.write(df)
             st.write(f"Time elapsed: {time.time() - start} seconds")
-            
-        elif option == 'Recommend Professors for Professor':
-            recommended_items = recommender.recommend_professors_to_professors(user_input)
-            df = pd.DataFrame(recommended_items, columns=['Professor GUID', 'Similarity Score'])
+    else:
+        uploaded_file = st.file_uploader("Upload a CSV of Student or Professor GUIDs (first column is used):", type='csv')
+
+        if uploaded_file is not None:
+            guids = read_guid_column(uploaded_file)
+
+            start = time.time()
+            df = bulk_results(recommender, method, column, guids)
+            st.write(f"{len(guids)} IDs, {len(df)} recommendations. Time elapsed: {time.time() - start} seconds")
             st.write(df)
-            st.write(f"Time elapsed: {time.time() - start} seconds")
+            st.download_button("Download results", df.to_csv(index=False), file_name='recommendations.csv', mime='text/csv')
 
 
 if __name__ == "__main__":
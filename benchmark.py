@@ -0,0 +1,290 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from embedding_store import export_embedding_store, export_guid_index, store_path, write_metadata, metadata_path, FIELD_COLUMN
+from recommendation_engine import ScholarlinkRecommendationEngine, build_index, index_path, index_bytes
+
+RECOMMEND_METHODS = {
+    'recommend_professors': 'student',
+    'recommend_students': 'professor',
+    'recommend_students_to_students': 'student',
+    'recommend_professors_to_professors': 'professor',
+}
+
+# Mode name -> engine parameters. Neighbour tables are only loaded by the mode that builds them, and
+# the result cache is off so every query measures a scan.
+MODES = {
+    'exact': {'index_type': 'exact', 'storage': 'memory'},
+    'exact-mmap': {'index_type': 'exact', 'storage': 'mmap'},
+    'ivf': {'index_type': 'ivf', 'storage': 'memory'},
+    'ivf-mmap': {'index_type': 'ivf', 'storage': 'mmap'},
+    'tables': {'index_type': 'exact', 'storage': 'memory', 'neighbour_tables': True},
+    'sharded': {'index_type': 'sharded', 'storage': 'memory'},
+    'sharded-mmap': {'index_type': 'sharded', 'storage': 'mmap'},
+    'float16': {'index_type': 'float16', 'storage': 'memory'},
+    'int8': {'index_type': 'int8', 'storage': 'memory'},
+    'int8-mmap': {'index_type': 'int8', 'storage': 'mmap'},
+    'pca': {'index_type': 'pca', 'storage': 'memory'},
+    'pca-int8': {'index_type': 'pca-int8', 'storage': 'memory'},
+    'pca-int8-mmap': {'index_type': 'pca-int8', 'storage': 'mmap'},
+}
+
+# Result metrics where a higher value is the regression; everything else regresses downwards.
+LOWER_IS_BETTER = ('p50', 'p95', 'p99', 'cold_start', 'index_build', 'index_mb', 'peak_rss_mb')
+
+
+def random_guids(rng, count):
+    return [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(count)]
+
+
+def generate_embeddings(path, count, dim, catalogue, rng, term_vectors, fields, block_size=65536):
+    # Written block by block into a preallocated .npy so catalogues of millions of rows never
+    # sit in memory. In 'vocabulary' mode each profile is the sum of the vectors of three
+    # research interests from its field plus noise, giving the field clusters of the real data.
+    embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(count, dim))
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        if catalogue == 'random':
+            block = rng.standard_normal((stop - start, dim), dtype=np.float32)
+        else:
+            field_terms = term_vectors[fields[start:stop]]
+            picks = np.argsort(rng.random((stop - start, field_terms.shape[1])), axis=1)[:, :3]
+            block = np.take_along_axis(field_terms, picks[:, :, None], axis=1).sum(axis=1)
+            block += 0.1 * rng.standard_normal(block.shape, dtype=np.float32)
+        embeddings[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    embeddings.flush()
+    del embeddings
+
+
+def generate_catalogue(directory, n_students, n_professors, dim=384, catalogue='random', seed=0):
+    params = {'students': n_students, 'professors': n_professors, 'dim': dim, 'catalogue': catalogue, 'seed': seed}
+    manifest_path = f'{directory}/catalogue.json'
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == params:
+                print(f"Reusing synthetic catalogue in {directory}")
+                return params
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    if catalogue == 'vocabulary':
+        from dataprep import RESEARCH_INTERESTS
+        field_names = sorted(RESEARCH_INTERESTS)
+        # Shared terms (e.g. Biochemistry) get one vector wherever they appear.
+        terms = sorted({term for interests in RESEARCH_INTERESTS.values() for term in interests})
+        vectors = rng.standard_normal((len(terms), dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        term_vectors = np.stack([vectors[[terms.index(term) for term in RESEARCH_INTERESTS[field]]] for field in field_names])
+    else:
+        field_names = [f'Field {i}' for i in range(10)]
+        term_vectors = None
+
+    for entity, count in (('student', n_students), ('professor', n_professors)):
+        fields = rng.integers(0, len(field_names), count)
+        embeddings_path = f'{directory}/{entity}_embeddings.npy'
+        generate_embeddings(embeddings_path, count, dim, catalogue, rng, term_vectors, fields)
+        guids = random_guids(rng, count)
+        with open(f'{directory}/{entity}_guids.json', 'w') as f:
+            json.dump(guids, f)
+        export_guid_index(f'{directory}/{entity}_guids.json', guids)
+        write_metadata(metadata_path(embeddings_path), pd.DataFrame({FIELD_COLUMN: np.asarray(field_names)[fields]}))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(params, f)
+    print(f"Generated {catalogue} catalogue of {n_students} students and {n_professors} professors "
+          f"in {time.time() - start:.1f} seconds")
+    return params
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_stats(latencies, queries):
+    latencies = np.asarray(latencies)
+    return {'p50': float(np.percentile(latencies, 50) * 1000), 'p95': float(np.percentile(latencies, 95) * 1000),
+            'p99': float(np.percentile(latencies, 99) * 1000), 'mean': float(latencies.mean() * 1000),
+            'throughput': queries / float(latencies.sum()), 'queries': queries}
+
+
+def build_mode(directory, mode, top_n):
+    # Times whatever the mode needs on disk before an engine can start, from scratch.
+    paths = [f'{directory}/student_embeddings.npy', f'{directory}/professor_embeddings.npy']
+    shutil.rmtree(f'{directory}/neighbours', ignore_errors=True)
+    start = time.time()
+    for embeddings_path in paths:
+        if MODES[mode]['storage'] == 'mmap':
+            for path in (store_path(embeddings_path), store_path(embeddings_path, normalized=True)):
+                if os.path.exists(path):
+                    os.remove(path)
+            export_embedding_store(embeddings_path, np.load(embeddings_path, mmap_mode='r'))
+        if MODES[mode]['index_type'] not in ('exact', 'sharded'):
+            if os.path.exists(index_path(embeddings_path, MODES[mode]['index_type'])):
+                os.remove(index_path(embeddings_path, MODES[mode]['index_type']))
+            build_index(embeddings_path, MODES[mode]['index_type'])
+    if mode == 'tables':
+        from precompute_neighbours import build_neighbour_tables
+        build_neighbour_tables(directory, top_k=top_n)
+    return time.time() - start
+
+
+def run_mode(directory, mode, methods, n_queries, batch_size, top_n, threshold, warmup, seed):
+    # Runs in a fresh process per mode, after build_mode ran in another one, so cold start and
+    # peak RSS cover only loading and querying, not earlier modes or the index build.
+    result = {'mode': mode, 'methods': []}
+
+    start = time.time()
+    engine = ScholarlinkRecommendationEngine(f'{directory}/student_embeddings.npy', f'{directory}/professor_embeddings.npy',
+                                             f'{directory}/student_guids.json', f'{directory}/professor_guids.json',
+                                             **{'neighbour_tables': False, 'cache_entries': 0, **MODES[mode]})
+    result['cold_start'] = time.time() - start
+    result['index_mb'] = (index_bytes(engine.student_search_index) + index_bytes(engine.professor_search_index)) / (1024 * 1024)
+
+    rng = np.random.default_rng(seed)
+    for method in methods:
+        guids = getattr(engine, f'{RECOMMEND_METHODS[method]}_guids')
+        queries = [guids[i] for i in rng.integers(0, len(guids), n_queries)]
+        recommend = getattr(engine, method)
+        recommend_batch = getattr(engine, f'{method}_batch')
+
+        for guid in queries[:warmup]:
+            recommend(guid, top_n=top_n, threshold=threshold)
+
+        latencies = []
+        for guid in queries:
+            start = time.perf_counter()
+            recommend(guid, top_n=top_n, threshold=threshold)
+            latencies.append(time.perf_counter() - start)
+        result['methods'].append({'method': method, 'kind': 'single', **latency_stats(latencies, len(queries))})
+
+        latencies = []
+        for i in range(0, len(queries), batch_size):
+            start = time.perf_counter()
+            recommend_batch(queries[i:i + batch_size], top_n=top_n, threshold=threshold)
+            latencies.append(time.perf_counter() - start)
+        result['methods'].append({'method': method, 'kind': f'batch{batch_size}', **latency_stats(latencies, len(queries))})
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_benchmark(directory, catalogue, modes, methods, n_queries=1000, batch_size=64, top_n=10, threshold=-1.0,
+                  warmup=20, seed=0):
+    results = {'created_at': time.time(), 'catalogue': catalogue,
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'platform': platform.platform(), 'cpus': os.cpu_count()},
+               'params': {'queries': n_queries, 'batch_size': batch_size, 'top_n': top_n, 'threshold': threshold},
+               'modes': []}
+
+    context = multiprocessing.get_context('spawn')
+    for mode in modes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            index_build = pool.submit(build_mode, directory, mode, top_n).result()
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_mode, directory, mode, methods, n_queries, batch_size, top_n, threshold,
+                                 warmup, seed).result()
+        result['index_build'] = index_build
+        results['modes'].append(result)
+        print(f"{mode}: index build {result['index_build']:.2f}s, cold start {result['cold_start']:.2f}s, "
+              f"index {result['index_mb']:.1f} MB, peak RSS {result['peak_rss_mb']:.0f} MB")
+        for row in result['methods']:
+            print(f"  {row['method']:<36} {row['kind']:<8} p50 {row['p50']:8.2f} ms  p95 {row['p95']:8.2f} ms  "
+                  f"p99 {row['p99']:8.2f} ms  {row['throughput']:10.1f} queries/s")
+    return results
+
+
+def flatten_results(results):
+    size = f"{results['catalogue']['students']}x{results['catalogue']['professors']}"
+    metrics = {}
+    for result in results['modes']:
+        for name in ('index_build', 'cold_start', 'index_mb', 'peak_rss_mb'):
+            if name in result:
+                metrics[(size, result['mode'], '', '', name)] = result[name]
+        for row in result['methods']:
+            for name in ('p50', 'p95', 'p99', 'throughput'):
+                metrics[(size, result['mode'], row['method'], row['kind'], name)] = row[name]
+    return metrics
+
+
+def compare_results(baseline_runs, current_runs, tolerance=0.10):
+    # Matches metrics by catalogue size, mode, method and batch kind; a metric regresses when it
+    # is worse than the baseline by more than the tolerance (a fraction of the baseline value).
+    baseline, current = {}, {}
+    for results in baseline_runs:
+        baseline.update(flatten_results(results))
+    for results in current_runs:
+        current.update(flatten_results(results))
+
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        old, new = baseline[key], current[key]
+        if old <= 0:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if key[-1] in LOWER_IS_BETTER else change < -tolerance
+        if worse:
+            regressions.append({'catalogue': key[0], 'mode': key[1], 'method': key[2], 'kind': key[3],
+                                'metric': key[4], 'baseline': old, 'current': new, 'change': change})
+            print(f"REGRESSION {' '.join(part for part in key if part)}: {old:.3f} -> {new:.3f} ({change:+.1%})")
+
+    print(f"Compared {len(set(baseline) & set(current))} metrics, {len(regressions)} regressions beyond {tolerance:.0%}")
+    return regressions
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)['runs']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation engine on synthetic catalogues")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                        help="Catalogue sizes to run; each size is used for both students and professors")
+    parser.add_argument('--catalogue', choices=['random', 'vocabulary'], default='random')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=['exact', 'exact-mmap', 'ivf', 'ivf-mmap'])
+    parser.add_argument('--methods', nargs='+', choices=list(RECOMMEND_METHODS), default=list(RECOMMEND_METHODS))
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=-1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default='./data/benchmark')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Earlier results file to check this run against")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="Only compare two results files")
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare_results(load_results(args.compare[0]), load_results(args.compare[1]), args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+    runs = []
+    for size in args.sizes:
+        directory = f'{args.work_dir}/{args.catalogue}-{size}-{args.dim}-{args.seed}'
+        catalogue = generate_catalogue(directory, size, size, args.dim, args.catalogue, args.seed)
+        runs.append(run_benchmark(directory, catalogue, args.modes, args.methods, args.queries, args.batch_size,
+                                  args.top_n, args.threshold, seed=args.seed))
+
+    with open(args.output, 'w') as f:
+        json.dump({'runs': runs}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare_results(load_results(args.baseline), runs, args.tolerance)
+        sys.exit(1 if regressions else 0)
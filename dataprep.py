@@ -1,16 +1,96 @@
+import os
+import argparse
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from faker import Faker
 import numpy as np
 import random
-from sentence_transformers import SentenceTransformer
+
+# University Field -> research interest vocabulary sampled for synthetic profiles
+RESEARCH_INTERESTS = {
+    'Physics': ['Astrophysics', 'Condensed Matter Physics', 'Cosmology', 'Experimental Physics', 'Nuclear Physics', 'Particle Physics', 'Photonics', 'Quantum Mechanics', 'Statistical Mechanics', 'Theoretical Physics'],
+    'Psychology': ['Biopsychology', 'Clinical Psychology', 'Cognitive Psychology', 'Developmental Psychology', 'Experimental Psychology', 'Forensic Psychology', 'Health Psychology', 'Personality Psychology', 'Psychometrics', 'Social Psychology'],
+    'Chemistry': ['Analytical Chemistry', 'Biochemistry', 'Environmental Chemistry', 'Inorganic Chemistry', 'Materials Science', 'Medicinal Chemistry', 'Organic Chemistry', 'Physical Chemistry', 'Polymer Science', 'Theoretical Chemistry'],
+    'History': ['Ancient History', 'Cultural History', 'Economic History', 'History of Science', 'Medieval History', 'Military History', 'Modern History', 'Political History', 'Social History', 'World History'],
+    'Mathematics': ['Algebra', 'Applied Mathematics', 'Calculus', 'Differential Equations', 'Geometry', 'Mathematical Physics', 'Number Theory', 'Probability', 'Statistics', 'Topology'],
+    'Literature': ['Comparative Literature', 'Creative Writing', 'Drama', 'Historiography', 'Literary Criticism', 'Narrative Theory', 'Novel', 'Poetry', 'Rhetoric', 'World Literature'],
+    'Engineering': ['Aerospace Engineering', 'Biomedical Engineering', 'Chemical Engineering', 'Civil Engineering', 'Electrical Engineering', 'Environmental Engineering', 'Industrial Engineering', 'Mechanical Engineering', 'Software Engineering', 'Systems Engineering'],
+    'Computer Science': ['Artificial Intelligence', 'Blockchain', 'Cloud Computing', 'Computer Vision', 'Cybersecurity', 'Data Science', 'Human-Computer Interaction', 'Machine Learning', 'Quantum Computing', 'Software Engineering'],
+    'Biology': ['Biochemistry', 'Cell Biology', 'Conservation Biology', 'Ecology', 'Evolutionary Biology', 'Genetics', 'Immunology', 'Marine Biology', 'Microbiology', 'Neuroscience'],
+    'Economics': ['Behavioral Economics', 'Development Economics', 'Econometrics', 'Financial Economics', 'Health Economics', 'International Economics', 'Labor Economics', 'Macroeconomics', 'Microeconomics', 'Public Economics'],
+}
+
+FIELDS = list(RESEARCH_INTERESTS)
+INTERESTS_PER_PROFILE = 3
+MAX_TERMS = max(len(terms) for terms in RESEARCH_INTERESTS.values())
+
+
+def build_interest_table():
+    # Every cleaned interest string a profile can get, indexed by field and the three sampled
+    # term positions, so a whole column is one np.take instead of a Faker call and a join per row.
+    # Terms are drawn with replacement like fake.words and de-duplicated/sorted like clean_text.
+    table = np.full(len(FIELDS) * MAX_TERMS ** INTERESTS_PER_PROFILE, '', dtype=object)
+    for f, field in enumerate(FIELDS):
+        terms = RESEARCH_INTERESTS[field]
+        for code in range(MAX_TERMS ** INTERESTS_PER_PROFILE):
+            positions = [code // MAX_TERMS ** p % MAX_TERMS for p in range(INTERESTS_PER_PROFILE)]
+            if max(positions) < len(terms):
+                table[f * MAX_TERMS ** INTERESTS_PER_PROFILE + code] = ','.join(sorted({terms[i] for i in positions}))
+    return table
+
+
+INTEREST_TABLE = build_interest_table()
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype='S1')
+
+
+def sample_interest_codes(rng, fields):
+    # fields: integer positions in FIELDS; returns row indices into INTEREST_TABLE.
+    lengths = np.array([len(RESEARCH_INTERESTS[field]) for field in FIELDS])[fields]
+    positions = (rng.random((len(fields), INTERESTS_PER_PROFILE)) * lengths[:, None]).astype(np.int64)
+    return fields * MAX_TERMS ** INTERESTS_PER_PROFILE + positions @ MAX_TERMS ** np.arange(INTERESTS_PER_PROFILE)
+
+
+def bulk_guids(rng, count):
+    # Random version 4 UUID strings, formatted as one character array instead of uuid4() per row.
+    raw = np.frombuffer(rng.bytes(16 * count), dtype=np.uint8).reshape(count, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    digits = HEX_DIGITS[np.stack([raw >> 4, raw & 0x0F], axis=2).reshape(count, 32)]
+    return np.insert(digits, [8, 12, 16, 20], b'-', axis=1).view('S36').ravel().astype(str)
+
+
+def generate_shard(path, guid_column, count, seed, first_names, last_names):
+    rng = np.random.default_rng(seed)
+    fields = rng.integers(0, len(FIELDS), count)
+    codes = sample_interest_codes(rng, fields)
+    names = np.char.add(np.char.add(first_names[rng.integers(0, len(first_names), count)], ' '),
+                        last_names[rng.integers(0, len(last_names), count)])
+    pd.DataFrame({guid_column: bulk_guids(rng, count), 'Name': names,
+                  'Research Interests': INTEREST_TABLE[codes],
+                  'University Field': np.asarray(FIELDS)[fields]}).to_csv(path, index=False)
+    return codes
+
 
 class UniversityDataGenerator:
-    def __init__(self, data_path, download_path, model_name):
+    def __init__(self, data_path, download_path, model_name, seed=0):
         self.data_path = data_path
         self.download_path = download_path
+        self.model_name = model_name
+        self.loaded_model = None
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
         self.fake = Faker()
-        self.model = SentenceTransformer(model_name)
-        
+        self.fake.seed_instance(seed)
+
+    @property
+    def model(self):
+        # Only needed when embeddings are requested; importing and loading it costs seconds.
+        if self.loaded_model is None:
+            from sentence_transformers import SentenceTransformer
+            self.loaded_model = SentenceTransformer(self.model_name)
+        return self.loaded_model
+
     def clean_text(self, text):
         try:
             result = text.split(',')
@@ -24,39 +104,35 @@ class UniversityDataGenerator:
 
     def generate_research_interests(self, university_field):
         try:
-            if university_field == 'Physics':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Astrophysics', 'Condensed Matter Physics', 'Cosmology', 'Experimental Physics', 'Nuclear Physics', 'Particle Physics', 'Photonics', 'Quantum Mechanics', 'Statistical Mechanics', 'Theoretical Physics'])
-            elif university_field == 'Psychology':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Biopsychology', 'Clinical Psychology', 'Cognitive Psychology', 'Developmental Psychology', 'Experimental Psychology', 'Forensic Psychology', 'Health Psychology', 'Personality Psychology', 'Psychometrics', 'Social Psychology'])
-            elif university_field == 'Chemistry':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Analytical Chemistry', 'Biochemistry', 'Environmental Chemistry', 'Inorganic Chemistry', 'Materials Science', 'Medicinal Chemistry', 'Organic Chemistry', 'Physical Chemistry', 'Polymer Science', 'Theoretical Chemistry'])
-            elif university_field == 'History':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Ancient History', 'Cultural History', 'Economic History', 'History of Science', 'Medieval History', 'Military History', 'Modern History', 'Political History', 'Social History', 'World History'])
-            elif university_field == 'Mathematics':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Algebra', 'Applied Mathematics', 'Calculus', 'Differential Equations', 'Geometry', 'Mathematical Physics', 'Number Theory', 'Probability', 'Statistics', 'Topology'])
-            elif university_field == 'Literature':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Comparative Literature', 'Creative Writing', 'Drama', 'Historiography', 'Literary Criticism', 'Narrative Theory', 'Novel', 'Poetry', 'Rhetoric', 'World Literature'])
-            elif university_field == 'Engineering':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Aerospace Engineering', 'Biomedical Engineering', 'Chemical Engineering', 'Civil Engineering', 'Electrical Engineering', 'Environmental Engineering', 'Industrial Engineering', 'Mechanical Engineering', 'Software Engineering', 'Systems Engineering'])
-            elif university_field == 'Computer Science':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Artificial Intelligence', 'Blockchain', 'Cloud Computing', 'Computer Vision', 'Cybersecurity', 'Data Science', 'Human-Computer Interaction', 'Machine Learning', 'Quantum Computing', 'Software Engineering'])
-            elif university_field == 'Biology':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Biochemistry', 'Cell Biology', 'Conservation Biology', 'Ecology', 'Evolutionary Biology', 'Genetics', 'Immunology', 'Marine Biology', 'Microbiology', 'Neuroscience'])
-            elif university_field == 'Economics':
-                return self.fake.words(nb=random.randint(3, 3), ext_word_list=['Behavioral Economics', 'Development Economics', 'Econometrics', 'Financial Economics', 'Health Economics', 'International Economics', 'Labor Economics', 'Macroeconomics', 'Microeconomics', 'Public Economics'])
+            if university_field in RESEARCH_INTERESTS:
+                return self.fake.words(nb=random.randint(3, 3), ext_word_list=RESEARCH_INTERESTS[university_field])
             else:
                 return None
         except Exception as e:
             print(f"Error generating research interests: {e}")
             return None
 
+    def research_interests(self, university_fields):
+        # Vectorized generate_research_interests + clean_text for a whole column; fields outside
+        # RESEARCH_INTERESTS get no interests.
+        fields = pd.Categorical(university_fields, categories=FIELDS).codes.astype(np.int64)
+        known = fields >= 0
+        interests = np.full(len(fields), None, dtype=object)
+        interests[known] = INTEREST_TABLE[sample_interest_codes(self.rng, fields[known])]
+        return interests
+
+    def name_tables(self, size=1000):
+        first_names = np.array(sorted({self.fake.first_name() for _ in range(size)}))
+        last_names = np.array(sorted({self.fake.last_name() for _ in range(size)}))
+        return first_names, last_names
+
     def generate_data(self):
         try:
             students = pd.read_excel(self.data_path, sheet_name='Students')
             professors = pd.read_excel(self.data_path, sheet_name='Professors')
 
-            students['Research Interests'] = students.apply(lambda x: self.clean_text(",".join(self.generate_research_interests(x['University Field']))), axis=1)
-            professors['Research Interests'] = professors.apply(lambda x: self.clean_text(",".join(self.generate_research_interests(x['University Field']))), axis=1)
+            students['Research Interests'] = self.research_interests(students['University Field'])
+            professors['Research Interests'] = self.research_interests(professors['University Field'])
 
             students.to_csv(f'{self.download_path}/students.csv', index=False)
             professors.to_csv(f'{self.download_path}/professors.csv', index=False)
@@ -65,9 +141,69 @@ class UniversityDataGenerator:
         except Exception as e:
             print(f"Error generating data: {e}")
 
+    def write_embeddings(self, path, codes, block_size=1000000):
+        # Only the distinct interest strings go through the model; rows are gathered from them.
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        vectors = np.asarray(self.model.encode(INTEREST_TABLE[unique_codes].tolist()), dtype=np.float32)
+        embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(codes), vectors.shape[1]))
+        for start in range(0, len(codes), block_size):
+            embeddings[start:start + block_size] = vectors[inverse[start:start + block_size]]
+        embeddings.flush()
+
+    def generate_synthetic(self, n_students, n_professors, shards=1, workers=None, embeddings=False, keep_shards=False):
+        # Fully synthetic profiles for load tests, written as shards by a process pool. Each
+        # shard has its own seed spawned from self.seed, so the output does not depend on the
+        # number of workers. Shards are then concatenated into students.csv/professors.csv.
+        try:
+            first_names, last_names = self.name_tables()
+            outputs = {}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for e, (entity, guid_column, count) in enumerate((('students', 'Student GUID', n_students),
+                                                                  ('professors', 'Professor GUID', n_professors))):
+                    shard_dir = f'{self.download_path}/{entity}_shards'
+                    os.makedirs(shard_dir, exist_ok=True)
+                    seeds = np.random.SeedSequence([self.seed, e]).spawn(shards)
+                    bounds = np.linspace(0, count, shards + 1).astype(np.int64)
+                    paths = [f'{shard_dir}/part-{i:05d}.csv' for i in range(shards)]
+                    futures = [pool.submit(generate_shard, paths[i], guid_column, int(bounds[i + 1] - bounds[i]), seeds[i],
+                                           first_names, last_names) for i in range(shards)]
+                    outputs[entity] = (shard_dir, paths, futures)
+
+                for entity, (shard_dir, paths, futures) in outputs.items():
+                    codes = np.concatenate([future.result() for future in futures])
+                    with open(f'{self.download_path}/{entity}.csv', 'wb') as out:
+                        for i, path in enumerate(paths):
+                            with open(path, 'rb') as f:
+                                if i:
+                                    f.readline()
+                                shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+                    if not keep_shards:
+                        shutil.rmtree(shard_dir)
+
+                    if embeddings:
+                        self.write_embeddings(f'{self.download_path}/{entity}_embeddings.npy', codes)
+
+            print(f"Generated {n_students} students and {n_professors} professors in {shards} shards.")
+        except Exception as e:
+            print(f"Error generating synthetic data: {e}")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic research interests for students and professors")
+    parser.add_argument('--students', type=int, help="Generate this many fully synthetic students instead of reading the Excel sheet")
+    parser.add_argument('--professors', type=int)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--embeddings', action='store_true', help="Also write row-aligned <entity>_embeddings.npy files")
+    parser.add_argument('--keep-shards', action='store_true')
+    args = parser.parse_args()
+
     data_path = './data/raw/university_data.xlsx'
     download_path = './data/raw'
     model_name = 'paraphrase-MiniLM-L6-v2'
-    data_generator = UniversityDataGenerator(data_path, download_path,  model_name)
-    data_generator.generate_data()
+    data_generator = UniversityDataGenerator(data_path, download_path,  model_name, args.seed)
+    if args.students is not None:
+        data_generator.generate_synthetic(args.students, args.professors if args.professors is not None else args.students,
+                                          args.shards, args.workers, args.embeddings, args.keep_shards)
+    else:
+        data_generator.generate_data()
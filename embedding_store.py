@@ -0,0 +1,681 @@
+import os
+import json
+import threading
+import time
+import shutil
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import normalize
+
+# On-disk layout: a fixed, page-aligned header followed by the raw C-ordered matrix.
+# The header is the magic bytes plus a JSON document describing the data, padded
+# with spaces, so it can be validated without touching the matrix itself.
+MAGIC = b'SLEMB\x00\x01\x00'
+HEADER_SIZE = 4096
+FORMAT_VERSION = 1
+
+
+def store_path(embeddings_path, normalized=False):
+    stem = os.path.splitext(embeddings_path)[0]
+    return f"{stem}.normalized.emb" if normalized else f"{stem}.emb"
+
+
+def write_embedding_store(path, embeddings, normalized=False, normalize_rows=False, block_size=65536, source=''):
+    # With normalize_rows the rows are normalized block by block while writing, so a
+    # memory-mapped input never has to be copied into the heap in full. source is the
+    # fingerprint of the .npy the store was exported from.
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'dtype': embeddings.dtype.str,
+        'shape': list(embeddings.shape),
+        'normalized': bool(normalized or normalize_rows),
+        'source': source,
+    }).encode('utf-8')
+    if len(MAGIC) + len(header) > HEADER_SIZE:
+        raise ValueError(f"Embedding store header too large for {path}")
+
+    # Written to a temporary file and renamed so readers never map a half-written store.
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC)))
+        for start in range(0, len(embeddings), block_size):
+            block = np.ascontiguousarray(embeddings[start:start + block_size])
+            if normalize_rows:
+                block = normalize(block).astype(embeddings.dtype, copy=False)
+            block.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_embedding_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+
+    if len(raw) != HEADER_SIZE or not raw.startswith(MAGIC):
+        raise ValueError(f"{path} is not an embedding store")
+
+    header = json.loads(raw[len(MAGIC):].decode('utf-8'))
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported embedding store version {header.get('version')} in {path}")
+
+    dtype = np.dtype(header['dtype'])
+    shape = tuple(header['shape'])
+    expected_size = HEADER_SIZE + int(np.prod(shape)) * dtype.itemsize
+    if os.path.getsize(path) != expected_size:
+        raise ValueError(f"Embedding store {path} is truncated or corrupt: expected {expected_size} bytes")
+
+    return {'dtype': dtype, 'shape': shape, 'normalized': header['normalized'], 'source': header.get('source', '')}
+
+
+def open_embedding_store(path, normalized=None, source=None):
+    header = read_embedding_header(path)
+    if normalized is not None and header['normalized'] != normalized:
+        raise ValueError(f"Embedding store {path} has normalized={header['normalized']}, expected {normalized}")
+    if source is not None and header['source'] != source:
+        raise ValueError(f"Embedding store {path} was exported from different embeddings")
+
+    # Read-only mapping: every process that opens the same file shares its page cache.
+    return np.memmap(path, dtype=header['dtype'], mode='r', offset=HEADER_SIZE, shape=header['shape'])
+
+
+def export_embedding_store(embeddings_path, embeddings=None):
+    # Writes the raw and pre-normalized stores next to a .npy written by RecommenderDataPrep.
+    source = source_fingerprint(embeddings_path)
+    if embeddings is None:
+        with open(embeddings_path, 'rb') as f:
+            embeddings = np.load(f)
+    write_embedding_store(store_path(embeddings_path), embeddings, source=source)
+    write_embedding_store(store_path(embeddings_path, normalized=True), embeddings, normalize_rows=True, source=source)
+
+
+def load_embedding_store(embeddings_path):
+    # Stores exported from an older version of the .npy are exported again; without the
+    # .npy the stores are served as they are.
+    source = source_fingerprint(embeddings_path) or None
+    try:
+        return (open_embedding_store(store_path(embeddings_path), normalized=False, source=source),
+                open_embedding_store(store_path(embeddings_path, normalized=True), normalized=True, source=source))
+    except (FileNotFoundError, ValueError) as e:
+        if source is None:
+            raise
+        print(f"Exporting embedding store for {embeddings_path}: {e}")
+        export_embedding_store(embeddings_path)
+        return (open_embedding_store(store_path(embeddings_path), normalized=False),
+                open_embedding_store(store_path(embeddings_path, normalized=True), normalized=True))
+
+
+def source_fingerprint(embeddings_path):
+    # Identifies the .npy a derived file (an embedding store, a search index) was built from.
+    # Vectors rewritten in place keep the shape, but not the file's mtime.
+    try:
+        stat = os.stat(embeddings_path)
+    except FileNotFoundError:
+        return ''
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+# GUID index: the GUIDs as 16-byte UUID records in row order, the same records sorted, and
+# the permutation from sorted position to row, behind the same page-aligned header as the
+# embedding stores. Memory-mapped, it replaces the JSON list (one Python string per row)
+# and the GUID -> row dict with binary searches over the mapped keys.
+GUID_MAGIC = b'SLGID\x00\x01\x00'
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype='S1')
+# ASCII code -> hex value; anything else (including upper case) is 255.
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+HEX_VALUES[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+HEX_COLUMNS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+
+
+def guid_index_path(guids_path):
+    return f"{os.path.splitext(guids_path)[0]}.guidx"
+
+
+def parse_guids(guids):
+    # Canonical lower-case UUID strings -> (n, 16) uint8 records; anything else is a ValueError
+    # so the records always format back to exactly the strings they came from.
+    if len(guids) == 0:
+        return np.empty((0, 16), dtype=np.uint8)
+    text = np.asarray(guids, dtype=str)
+    if text.dtype.itemsize != 36 * 4 or np.any(np.char.str_len(text) != 36):
+        raise ValueError("GUIDs are not all 36-character UUID strings")
+    try:
+        chars = np.frombuffer(text.astype('S36').tobytes(), dtype=np.uint8).reshape(len(text), 36)
+    except UnicodeEncodeError as e:
+        raise ValueError(f"GUIDs are not ASCII UUID strings: {e}")
+    nibbles = HEX_VALUES[chars[:, HEX_COLUMNS]]
+    if np.any(chars[:, [8, 13, 18, 23]] != ord('-')) or np.any(nibbles == 255):
+        raise ValueError("GUIDs are not all canonical lower-case UUID strings")
+    return np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+
+
+def format_guid_chars(records):
+    digits = HEX_DIGITS[np.stack([records >> 4, records & 0x0F], axis=2).reshape(len(records), 32)]
+    return np.insert(digits, [8, 12, 16, 20], b'-', axis=1)
+
+
+def format_guids(records):
+    return format_guid_chars(records).view('S36').ravel().astype(str).tolist()
+
+
+def format_guid_hex(digits):
+    # Small batches: one hex() call and string slicing beats the array formatting above.
+    return [f"{digits[i:i + 8]}-{digits[i + 8:i + 12]}-{digits[i + 12:i + 16]}-{digits[i + 16:i + 20]}-{digits[i + 20:i + 32]}"
+            for i in range(0, len(digits), 32)]
+
+
+def guid_key(guid):
+    # 16-byte record of one canonical UUID string, or None.
+    if not isinstance(guid, str) or len(guid) != 36 or guid != guid.lower() or \
+            guid[8] != '-' or guid[13] != '-' or guid[18] != '-' or guid[23] != '-':
+        return None
+    try:
+        return bytes.fromhex(guid[:8] + guid[9:13] + guid[14:18] + guid[19:23] + guid[24:])
+    except ValueError:
+        return None
+
+
+def write_guid_index(path, guids):
+    records = parse_guids(guids)
+    keys = records.view('S16').ravel()
+    order = np.argsort(keys, kind='stable')
+    if len(keys) > 1 and np.any(keys[order[1:]] == keys[order[:-1]]):
+        raise ValueError(f"Duplicate GUIDs, not writing {path}")
+
+    header = json.dumps({'version': FORMAT_VERSION, 'count': len(records)}).encode('utf-8')
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(GUID_MAGIC + header.ljust(HEADER_SIZE - len(GUID_MAGIC)))
+        records.tofile(f)
+        records[order].tofile(f)
+        order.astype(np.int64).tofile(f)
+    os.replace(tmp_path, path)
+
+
+def export_guid_index(guids_path, guids):
+    # Written next to every GUID JSON list; GUIDs that are not canonical UUIDs stay JSON-only,
+    # and a .skip marker records that so later loads go straight to the JSON list.
+    skip_path = f"{guid_index_path(guids_path)}.skip"
+    try:
+        write_guid_index(guid_index_path(guids_path), guids)
+        if os.path.exists(skip_path):
+            os.remove(skip_path)
+        return True
+    except ValueError as e:
+        print(f"Skipping GUID index for {guids_path}: {e}")
+        with open(skip_path, 'w') as f:
+            f.write(str(e))
+        return False
+
+
+class GuidList:
+    # Row -> GUID string view over mapped records, usable where the JSON list was.
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return GuidList(self.records[row])
+        return format_guid_hex(self.records[row].tobytes().hex())[0]
+
+    def __iter__(self, block_size=65536):
+        for start in range(0, len(self.records), block_size):
+            yield from format_guids(self.records[start:start + block_size])
+
+    def take(self, rows):
+        return format_guid_hex(self.records[rows].tobytes().hex())
+
+    def tolist(self):
+        return list(self)
+
+    def fingerprint(self, block_size=1000000):
+        # Same digest as hashlib.sha1("\n".join(guids)) over the strings, without creating them.
+        digest = hashlib.sha1()
+        for start in range(0, len(self.records), block_size):
+            chars = format_guid_chars(self.records[start:start + block_size])
+            lines = np.concatenate([chars, np.full((len(chars), 1), b'\n', dtype='S1')], axis=1).tobytes()
+            digest.update(lines if start + block_size < len(self.records) else lines[:-1])
+        return digest.hexdigest()
+
+
+class GuidIndex:
+    # GUID -> row mapping (dict-like: [], get, in) plus a vectorized rows() for batches.
+    def __init__(self, records, sorted_keys, order):
+        self.records = records
+        self.sorted_keys = sorted_keys
+        self.order = order
+        self.guids = GuidList(records)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) != HEADER_SIZE or not raw.startswith(GUID_MAGIC):
+            raise ValueError(f"{path} is not a GUID index")
+        header = json.loads(raw[len(GUID_MAGIC):].decode('utf-8'))
+        if header.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported GUID index version {header.get('version')} in {path}")
+        count = header['count']
+        if os.path.getsize(path) != HEADER_SIZE + count * 40:
+            raise ValueError(f"GUID index {path} is truncated or corrupt")
+        if count == 0:
+            return cls(np.empty((0, 16), dtype=np.uint8), np.empty(0, dtype='S16'), np.empty(0, dtype=np.int64))
+
+        # Plain ndarray views of the mapping: indexing an np.memmap is several times slower.
+        data = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE).view(np.ndarray)
+        return cls(data[:count * 16].reshape(count, 16), data[count * 16:count * 32].view('S16'),
+                   data[count * 32:].view(np.int64))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, guid):
+        return self.get(guid) is not None
+
+    def __getitem__(self, guid):
+        row = self.get(guid)
+        if row is None:
+            raise KeyError(guid)
+        return row
+
+    def get(self, guid, default=None):
+        key = guid_key(guid)
+        if key is None or len(self.sorted_keys) == 0:
+            return default
+        position = self.sorted_keys.searchsorted(key)
+        # Compared as raw bytes: numpy drops trailing zero bytes from a single S16 element.
+        if position < len(self.sorted_keys) and self.sorted_keys[position:position + 1].tobytes() == key:
+            return int(self.order[position])
+        return default
+
+    def rows(self, guids):
+        # Row of each GUID, or -1 for GUIDs that are missing or not canonical UUID strings.
+        guids = list(guids)
+        if len(self.sorted_keys) == 0:
+            return np.full(len(guids), -1, dtype=np.int64)
+        valid = np.ones(len(guids), dtype=bool)
+        try:
+            keys = parse_guids(guids).view('S16').ravel()
+        except ValueError:
+            keys = np.zeros(len(guids), dtype='S16')
+            for i, guid in enumerate(guids):
+                key = guid_key(guid)
+                if key is None:
+                    valid[i] = False
+                else:
+                    keys[i] = key
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        return np.where(valid & (self.sorted_keys[positions] == keys), self.order[positions], -1)
+
+
+def load_guids(guids_path):
+    # Returns (guids, index): a row -> GUID sequence and a GUID -> row mapping. The binary
+    # index is exported from the JSON list on first use, like the embedding stores.
+    path = guid_index_path(guids_path)
+    skip_path = f"{path}.skip"
+    if os.path.exists(skip_path) and os.path.getmtime(skip_path) >= os.path.getmtime(guids_path):
+        with open(guids_path, 'r') as f:
+            guids = json.load(f)
+        return guids, {guid: i for i, guid in enumerate(guids)}
+    try:
+        if os.path.exists(guids_path) and os.path.getmtime(guids_path) > os.path.getmtime(path):
+            raise ValueError(f"{path} is older than {guids_path}")
+        index = GuidIndex.open(path)
+        return index.guids, index
+    except (FileNotFoundError, ValueError) as e:
+        with open(guids_path, 'r') as f:
+            guids = json.load(f)
+        if export_guid_index(guids_path, guids):
+            print(f"Exported GUID index for {guids_path}: {e}")
+            index = GuidIndex.open(path)
+            return index.guids, index
+        return guids, {guid: i for i, guid in enumerate(guids)}
+
+
+# Metadata sidecars hold the non-text CSV columns (e.g. University Field) row-aligned with
+# the embeddings. Each column is stored as integer codes plus its categories.
+FIELD_COLUMN = 'University Field'
+
+
+def metadata_path(embeddings_path):
+    stem, _ = os.path.splitext(embeddings_path)
+    head, _, tail = stem.rpartition('_embeddings')
+    return f"{head}_metadata{tail}.npz"
+
+
+def write_metadata(path, metadata):
+    arrays = {'columns': np.array(metadata.columns, dtype=str)}
+    for i, column in enumerate(metadata.columns):
+        codes, categories = pd.factorize(metadata[column].astype(str), sort=True)
+        arrays[f'codes_{i}'] = codes.astype(np.int32)
+        arrays[f'categories_{i}'] = np.asarray(categories, dtype=str)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class MetadataColumns:
+    def __init__(self, columns):
+        # columns: name -> (codes, categories)
+        self.columns = columns
+        self.partitions = {}
+        self.decoded = {}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls({column: (data[f'codes_{i}'], data[f'categories_{i}'])
+                        for i, column in enumerate(data['columns'].tolist())})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))[0]) if self.columns else 0
+
+    def __getitem__(self, column):
+        # Decoded column values, for callable filters.
+        if column not in self.decoded:
+            codes, categories = self.columns[column]
+            self.decoded[column] = categories[codes]
+        return self.decoded[column]
+
+    def value(self, column, row):
+        codes, categories = self.columns[column]
+        return categories[codes[row]]
+
+    def value_codes(self, column, values):
+        return np.flatnonzero(np.isin(self.columns[column][1], np.asarray(values, dtype=str)))
+
+    def partition(self, column, value):
+        # Rows grouped by code once per column, so one value's rows are a contiguous slice.
+        if column not in self.partitions:
+            codes, categories = self.columns[column]
+            order = np.argsort(codes, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(categories)))])
+            self.partitions[column] = (order, offsets)
+
+        order, offsets = self.partitions[column]
+        codes = self.value_codes(column, [value])
+        if not len(codes):
+            return np.empty(0, dtype=np.int64)
+        return order[offsets[codes[0]]:offsets[codes[0] + 1]]
+
+    def select(self, fields=None, where=None):
+        # Returns the sorted candidate rows, or None when nothing is filtered. fields reads
+        # only the matching University Field partitions; where is either a dict of
+        # column -> value(s) or a callable taking this object and returning a boolean mask.
+        rows = None
+        if fields is not None:
+            fields = [fields] if isinstance(fields, str) else fields
+            rows = np.sort(np.concatenate([self.partition(FIELD_COLUMN, field) for field in fields] or [np.empty(0, dtype=np.int64)]))
+
+        if where is not None:
+            if callable(where):
+                mask = np.asarray(where(self), dtype=bool)
+            else:
+                mask = np.ones(len(self), dtype=bool)
+                for column, values in where.items():
+                    values = [values] if isinstance(values, str) else list(values)
+                    mask &= np.isin(self.columns[column][0], self.value_codes(column, values))
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+
+        return rows
+
+
+# Snapshots are published as versioned directories under a root, e.g.
+# snapshots/v000003/{student,professor}_{embeddings.npy,guids.json} plus manifest.json.
+# A directory is renamed into place only once it is complete, and CURRENT names the
+# live version, so readers never see the files of two different versions together.
+SNAPSHOT_FILES = ('student_embeddings.npy', 'professor_embeddings.npy', 'student_guids.json', 'professor_guids.json')
+
+
+def snapshot_paths(directory):
+    return tuple(os.path.join(directory, name) for name in SNAPSHOT_FILES)
+
+
+def snapshot_versions(root):
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(name[1:]) for name in os.listdir(root) if name.startswith('v') and name[1:].isdigit())
+
+
+def publish_snapshot(root, write_files, manifest, keep=3):
+    os.makedirs(root, exist_ok=True)
+    version = max(snapshot_versions(root), default=0) + 1
+
+    staging = os.path.join(root, f'.staging-v{version:06d}-{os.getpid()}')
+    os.makedirs(staging)
+    write_files(staging)
+
+    manifest = dict(manifest, version=version, created_at=time.time(), files=list(SNAPSHOT_FILES))
+    with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    os.rename(staging, os.path.join(root, f'v{version:06d}'))
+
+    tmp_path = os.path.join(root, f'CURRENT.tmp.{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        f.write(f'v{version:06d}')
+    os.replace(tmp_path, os.path.join(root, 'CURRENT'))
+
+    # Older versions are pruned; engines still holding one keep their open mappings.
+    for old_version in snapshot_versions(root)[:-keep]:
+        shutil.rmtree(os.path.join(root, f'v{old_version:06d}'), ignore_errors=True)
+
+    return version
+
+
+def replace_files(directory, write_files):
+    # Flat-layout counterpart of publish_snapshot: the files are written into a staging
+    # directory and each one is renamed over its old version, so readers never open a
+    # half-written file. Only a snapshot switches all of them at once.
+    staging = os.path.join(directory, f'.staging-{os.getpid()}')
+    os.makedirs(staging)
+    try:
+        write_files(staging)
+        for name in sorted(os.listdir(staging)):
+            os.replace(os.path.join(staging, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def current_snapshot(root):
+    with open(os.path.join(root, 'CURRENT'), 'r') as f:
+        directory = os.path.join(root, f.read().strip())
+    with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    return directory, manifest
+
+
+class IncrementalEmbeddingStore:
+    # GUID-keyed store built from append-only segments. Each upsert writes a new segment
+    # holding only the changed rows; the catalog maps every live GUID to its content hash
+    # and (segment, row). Deleted GUIDs are tombstoned by dropping them from the catalog,
+    # and compaction later rewrites segments that are mostly dead.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        self.catalog = {}
+        self.next_segment = 0
+        catalog_path = os.path.join(path, 'catalog.json')
+        if os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as f:
+                saved = json.load(f)
+            self.catalog = {guid: tuple(entry) for guid, entry in saved['catalog'].items()}
+            self.next_segment = saved['next_segment']
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f'segment_{segment:06d}.npy')
+
+    def save_catalog(self):
+        with self.lock:
+            catalog_path = os.path.join(self.path, 'catalog.json')
+            tmp_path = f"{catalog_path}.tmp.{os.getpid()}"
+            with open(tmp_path, 'w') as f:
+                json.dump({'next_segment': self.next_segment, 'catalog': self.catalog}, f)
+            os.replace(tmp_path, catalog_path)
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def diff(self, guids, content_hashes):
+        # Returns a mask of rows that are new or whose content changed, plus the GUIDs
+        # that are in the store but no longer in the input.
+        with self.lock:
+            changed = np.array([self.catalog.get(guid, (None,))[0] != content_hash
+                                for guid, content_hash in zip(guids, content_hashes)], dtype=bool)
+            deleted = set(self.catalog).difference(guids)
+        return changed, sorted(deleted)
+
+    def write_segment(self, embeddings):
+        with self.lock:
+            segment = self.next_segment
+            self.next_segment += 1
+        with open(self.segment_path(segment), 'wb') as f:
+            np.save(f, embeddings)
+        return segment
+
+    def upsert(self, guids, content_hashes, embeddings):
+        if len(guids) == 0:
+            return
+        with self.lock:
+            segment = self.write_segment(np.asarray(embeddings))
+            for row, (guid, content_hash) in enumerate(zip(guids, content_hashes)):
+                self.catalog[guid] = (content_hash, segment, row)
+            self.save_catalog()
+
+    def delete(self, guids):
+        if len(guids) == 0:
+            return
+        with self.lock:
+            for guid in guids:
+                self.catalog.pop(guid, None)
+            self.save_catalog()
+
+    def materialize(self):
+        # Returns the live GUIDs and their embeddings as one aligned matrix.
+        with self.lock:
+            guids = list(self.catalog)
+            locations = np.array([self.catalog[guid][1:] for guid in guids], dtype=np.int64).reshape(-1, 2)
+
+            embeddings = None
+            for segment in np.unique(locations[:, 0]):
+                data = np.load(self.segment_path(segment), mmap_mode='r')
+                if embeddings is None:
+                    embeddings = np.empty((len(guids), data.shape[1]), dtype=data.dtype)
+                positions = np.flatnonzero(locations[:, 0] == segment)
+                embeddings[positions] = data[locations[positions, 1]]
+
+        if embeddings is None:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+        return guids, embeddings
+
+    def compact(self, min_live_ratio=0.5):
+        with self.lock:
+            last_segment = self.next_segment
+            live = {}
+            for guid, entry in self.catalog.items():
+                live.setdefault(entry[1], []).append((guid, entry))
+
+        sizes = {segment: np.load(self.segment_path(segment), mmap_mode='r').shape[0]
+                 for segment in range(last_segment) if os.path.exists(self.segment_path(segment))}
+        sparse = [segment for segment, size in sizes.items() if len(live.get(segment, [])) < min_live_ratio * size]
+        if not sparse:
+            return 0
+
+        # Live rows of the sparse segments are copied into one new segment outside the lock;
+        # entries upserted or deleted meanwhile are left alone when the catalog is updated.
+        moved, rows = [], []
+        for segment in sparse:
+            if live.get(segment):
+                moved.extend(live[segment])
+                data = np.load(self.segment_path(segment), mmap_mode='r')
+                rows.append(data[[entry[2] for _, entry in live[segment]]])
+        if moved:
+            new_segment = self.write_segment(np.concatenate(rows))
+
+        with self.lock:
+            for row, (guid, entry) in enumerate(moved):
+                if self.catalog.get(guid) == entry:
+                    self.catalog[guid] = (entry[0], new_segment, row)
+            self.save_catalog()
+            for segment in sparse:
+                os.remove(self.segment_path(segment))
+        return len(sparse)
+
+    def compact_in_background(self, min_live_ratio=0.5):
+        thread = threading.Thread(target=self.compact, args=(min_live_ratio,), daemon=True)
+        thread.start()
+        return thread
+
+
+class EmbeddingCache:
+    # Content-addressed cache from a canonical text key to its embedding, bounded to
+    # max_entries with least-recently-used eviction and optionally persisted to an .npz.
+    # A file saved for a different model is ignored and overwritten on the next save.
+    def __init__(self, path=None, max_entries=100000, model=''):
+        self.path = path
+        self.max_entries = max_entries
+        self.model = model
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Set by put_many, so save() only rewrites the file when something was added.
+        self.dirty = False
+
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                if 'model' in data.files and str(data['model']) == model:
+                    for key, vector in zip(data['keys'].tolist(), data['vectors']):
+                        self.entries[key] = vector
+                else:
+                    print(f"Ignoring embedding cache {path}: built for a different model")
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        with self.lock:
+            vectors = []
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                vectors.append(vector)
+            return vectors
+
+    def put_many(self, keys, vectors):
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self.entries[key] = vector
+                self.entries.move_to_end(key)
+                self.dirty = True
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            keys = np.array(list(self.entries), dtype=str)
+            vectors = np.stack(list(self.entries.values())) if self.entries else np.empty((0, 0), dtype=np.float32)
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=keys, vectors=vectors, model=self.model)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
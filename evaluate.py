@@ -1,9 +1,66 @@
+import argparse
+import json
+import time
 import pandas as pd
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import normalize
 import numpy as np
 from recommendation_dataprep import RecommenderDataPrep
-from recommendation_engine import ScholarlinkRecommendationEngine
+from recommendation_engine import ScholarlinkRecommendationEngine, ExactIndex, index_bytes
+from embedding_store import FIELD_COLUMN
+from benchmark import MODES, latency_stats
+
+# candidates() overwrites University Field with a random one; the field the profile was
+# generated for is kept here and used as the ground truth label.
+LABEL_COLUMN = 'Original Field'
+
+# Relation -> (query entity, candidate entity, single-query method).
+RELATIONS = {
+    'student_professor': ('student', 'professor', 'recommend_professors'),
+    'professor_student': ('professor', 'student', 'recommend_students'),
+    'student_student': ('student', 'student', 'recommend_students_to_students'),
+    'professor_professor': ('professor', 'professor', 'recommend_professors_to_professors'),
+}
+
+
+def guid_rows(index, guids):
+    if not len(guids):
+        return np.empty(0, dtype=np.int64)
+    if hasattr(index, 'rows'):
+        return index.rows(guids)
+    return np.fromiter((index.get(guid, -1) for guid in guids), dtype=np.int64, count=len(guids))
+
+
+def ranked_rows(results, index, width):
+    # Result lists of (GUID, score) -> an (n, width) array of candidate rows, -1 past the end of a list.
+    counts = np.fromiter(map(len, results), dtype=np.int64, count=len(results))
+    rows = guid_rows(index, [guid for result in results for guid, _ in result])
+    ranked = np.full((len(results), width), -1, dtype=np.int64)
+    ranked[np.repeat(np.arange(len(results)), counts), np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)] = rows
+    return ranked
+
+
+def exclude_self(ranked, query_rows, k):
+    # Same-entity relations ask for k + 1 results and drop the query itself, keeping the order.
+    keep = ranked != query_rows[:, None]
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+    return np.where(np.take_along_axis(keep, order, axis=1), np.take_along_axis(ranked, order, axis=1), -1)
+
+
+def label_scores(ranked, query_labels, candidate_labels, same_entity):
+    # Precision@k and recall@k where a candidate is relevant if it shares the query's label.
+    codes, inverse = np.unique(np.concatenate([query_labels, candidate_labels]), return_inverse=True)
+    query_codes, candidate_codes = inverse[:len(query_labels)], inverse[len(query_labels):]
+    relevant = np.bincount(candidate_codes, minlength=len(codes))[query_codes] - (1 if same_entity else 0)
+    hits = ((ranked >= 0) & (candidate_codes[np.maximum(ranked, 0)] == query_codes[:, None])).sum(axis=1)
+    return float((hits / ranked.shape[1]).mean()), float((hits / np.maximum(relevant, 1)).mean())
+
+
+def overlap_recall(ranked, reference):
+    # Share of the exact top-k each query's results recover.
+    found = ((ranked[:, :, None] == reference[:, None, :]) & (reference[:, None, :] >= 0)).any(axis=1)
+    return float((found.sum(axis=1) / np.maximum((reference >= 0).sum(axis=1), 1)).mean())
+
 
 class DataPreparation:
     def __init__(self, students_path, professors_path):
@@ -21,23 +78,23 @@ class DataPreparation:
             print(f"Error cleaning text: {e}")
             return None
 
+    def field_head(self, df, n):
+        # First n rows of every field in one pass, grouped by field in order of first appearance.
+        selected_df = df.groupby('University Field', sort=False).head(n)
+        return selected_df.iloc[np.argsort(pd.factorize(selected_df['University Field'])[0], kind='stable')]
+
     def select_candidates(self, df):
         try:
-            selected_df = pd.DataFrame()
-            for field in df['University Field'].unique():
-                selected_df = pd.concat([selected_df, df[df['University Field'] == field].head(100)], axis=0)
-            return selected_df
+            return self.field_head(df, 100)
         except Exception as e:
             print(f"Error selecting candidates: {e}")
             return None
 
     def candidates(self, df):
         try:
-            selected_df = pd.DataFrame()
-            for field in df['University Field'].unique():
-                candidates = df[df['University Field'] == field].head(50)
-                candidates['University Field'] = np.random.choice(df['University Field'].unique(), len(candidates))
-                selected_df = pd.concat([selected_df, candidates], axis=0)
+            selected_df = self.field_head(df, 50).copy()
+            selected_df[LABEL_COLUMN] = selected_df['University Field']
+            selected_df['University Field'] = np.random.choice(df['University Field'].unique(), len(selected_df))
             return selected_df
         except Exception as e:
             print(f"Error generating candidates: {e}")
@@ -73,7 +130,11 @@ class EmbeddingCreation:
             student_guids = students['Student GUID'].tolist()
             professor_guids = professors['Professor GUID'].tolist()
 
-            data_prep.save_embeddings_and_guids(student_embeddings, professor_embeddings, student_guids, professor_guids)
+            student_metadata = data_prep.metadata_columns(students, 'Student GUID', student_guids)
+            professor_metadata = data_prep.metadata_columns(professors, 'Professor GUID', professor_guids)
+
+            data_prep.save_embeddings_and_guids(student_embeddings, professor_embeddings, student_guids, professor_guids,
+                                                student_metadata, professor_metadata)
         except Exception as e:
             print(f"Error creating embeddings: {e}")
 
@@ -114,23 +175,115 @@ class RecommendationTest:
         except Exception as e:
             print(f"Error evaluating recommendations: {e}")
 
+    def engine(self, mode):
+        return ScholarlinkRecommendationEngine(self.student_embeddings_path, self.professor_embeddings_path,
+                                               self.student_guids_path, self.professor_guids_path,
+                                               **{'neighbour_tables': False, 'cache_entries': 0, **MODES[mode]})
+
+    def labels(self, metadata):
+        if metadata is None:
+            return None
+        column = LABEL_COLUMN if LABEL_COLUMN in metadata.columns else FIELD_COLUMN
+        return metadata[column] if column in metadata.columns else None
+
+    def evaluate_relation(self, engine, relation, k, batch_size, latency_queries, reference, seed):
+        query_entity, candidate_entity, method = RELATIONS[relation]
+        same_entity = query_entity == candidate_entity
+        snapshot = engine.snapshot
+        query_guids = list(getattr(snapshot, f'{query_entity}_guids'))
+        candidate_index = getattr(snapshot, f'{candidate_entity}_index')
+        width = k + 1 if same_entity else k
+        query_rows = np.arange(len(query_guids))
+
+        # Every query of the split goes through the engine's batch path; only the ranking is
+        # scored, so the threshold is disabled.
+        recommend_batch = getattr(engine, f'{method}_batch')
+        batch_latencies = []
+        ranked = []
+        for i in range(0, len(query_guids), batch_size):
+            start = time.perf_counter()
+            results = recommend_batch(query_guids[i:i + batch_size], top_n=width, threshold=-1.0)
+            batch_latencies.append(time.perf_counter() - start)
+            ranked.append(ranked_rows(results, candidate_index, width))
+        ranked = np.concatenate(ranked) if ranked else np.empty((0, width), dtype=np.int64)
+        if same_entity:
+            ranked = exclude_self(ranked, query_rows, k)
+
+        # Exact brute force over the same normalized matrices is the reference for every mode.
+        if relation not in reference:
+            candidate_embeddings = getattr(snapshot, f'normalized_{candidate_entity}_embeddings')
+            query_embeddings = getattr(snapshot, f'normalized_{query_entity}_embeddings')
+            matches = ExactIndex(candidate_embeddings).search_batch(query_embeddings, min(width, len(candidate_embeddings)))
+            exact = np.full((len(matches), width), -1, dtype=np.int64)
+            for i, (indices, _) in enumerate(matches):
+                exact[i, :len(indices)] = indices
+            reference[relation] = exclude_self(exact, query_rows, k) if same_entity else exact
+
+        rng = np.random.default_rng(seed)
+        recommend = getattr(engine, method)
+        single_latencies = []
+        for row in rng.integers(0, len(query_guids), min(latency_queries, len(query_guids))):
+            start = time.perf_counter()
+            recommend(query_guids[row], top_n=k, threshold=-1.0)
+            single_latencies.append(time.perf_counter() - start)
+
+        result = {'relation': relation, 'queries': len(query_guids),
+                  'exact_recall': overlap_recall(ranked, reference[relation]),
+                  'single': latency_stats(single_latencies, len(single_latencies)) if single_latencies else None,
+                  f'batch{batch_size}': latency_stats(batch_latencies, len(query_guids)) if batch_latencies else None}
+
+        query_labels = self.labels(getattr(snapshot, f'{query_entity}_metadata'))
+        candidate_labels = self.labels(getattr(snapshot, f'{candidate_entity}_metadata'))
+        if query_labels is not None and candidate_labels is not None:
+            result['precision'], result['recall'] = label_scores(ranked, query_labels, candidate_labels, same_entity)
+        return result
+
+    def evaluate(self, modes=('exact', 'ivf'), relations=tuple(RELATIONS), k=10, batch_size=256, latency_queries=1000, seed=0):
+        report = {'created_at': time.time(), 'k': k, 'batch_size': batch_size, 'modes': []}
+        reference = {}
+        for mode in modes:
+            start = time.time()
+            engine = self.engine(mode)
+            result = {'mode': mode, 'cold_start': time.time() - start, 'relations': [],
+                      'index_bytes': {entity: index_bytes(getattr(engine.snapshot, f'{entity}_search_index')) for entity in ('student', 'professor')}}
+            for relation in relations:
+                row = self.evaluate_relation(engine, relation, k, batch_size, latency_queries, reference, seed)
+                result['relations'].append(row)
+                labels = f"precision@{k} {row['precision']:.3f}  recall@{k} {row['recall']:.4f}  " if 'precision' in row else ''
+                latency = f"p50 {row['single']['p50']:.2f} ms  p99 {row['single']['p99']:.2f} ms  " if row['single'] else ''
+                print(f"{mode:<10} {relation:<20} {labels}exact recall@{k} {row['exact_recall']:.3f}  {latency}"
+                      f"{row[f'batch{batch_size}']['throughput']:.0f} queries/s batched")
+            report['modes'].append(result)
+        return report
+
 if __name__ == "__main__":
-    # Test data creation
-    students_path = './data/raw/students.csv'
-    professors_path = './data/raw/professors.csv'
-    students_output_path = './data/evaluate_data/students_test.csv'
-    professors_output_path = './data/evaluate_data/professors_test.csv'
-
-    data_prep = DataPreparation(students_path, professors_path)
-    data_prep.prepare_test_data(students_output_path, professors_output_path)
-
-    # Creating test data embedding
-    students_data_path = './data/evaluate_data/students_test.csv'
-    professors_data_path = './data/evaluate_data/professors_test.csv'
-    data_download_path = './data/evaluate_data'
+    parser = argparse.ArgumentParser(description="Score every entity of the test split against field labels and exact search")
+    parser.add_argument('--modes', nargs='+', default=['exact', 'ivf'], choices=list(MODES))
+    parser.add_argument('--relations', nargs='+', default=list(RELATIONS), choices=list(RELATIONS))
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--latency-queries', type=int, default=1000, help="Queries timed one at a time per relation")
+    parser.add_argument('--skip-data', action='store_true', help="Reuse the test split and embeddings already on disk")
+    parser.add_argument('--output', default='./data/evaluate_data/evaluation.json')
+    args = parser.parse_args()
+
+    if not args.skip_data:
+        # Test data creation
+        students_path = './data/raw/students.csv'
+        professors_path = './data/raw/professors.csv'
+        students_output_path = './data/evaluate_data/students_test.csv'
+        professors_output_path = './data/evaluate_data/professors_test.csv'
 
-    embedding_creation = EmbeddingCreation(students_data_path, professors_data_path, data_download_path)
-    embedding_creation.create_embeddings()
+        data_prep = DataPreparation(students_path, professors_path)
+        data_prep.prepare_test_data(students_output_path, professors_output_path)
+
+        # Creating test data embedding
+        students_data_path = './data/evaluate_data/students_test.csv'
+        professors_data_path = './data/evaluate_data/professors_test.csv'
+        data_download_path = './data/evaluate_data'
+
+        embedding_creation = EmbeddingCreation(students_data_path, professors_data_path, data_download_path)
+        embedding_creation.create_embeddings()
 
 
     # Recommendation Engine Test
@@ -143,7 +296,7 @@ if __name__ == "__main__":
     recommendation_test = RecommendationTest(student_embeddings_path, professor_embeddings_path, 
                                             student_guids_path, professor_guids_path, data_download_path)
 
-    student_id = '2e8bb391-c77b-4e79-8f67-fd6614f5335a'
-    professor_id = '3ff367d3-dd69-461a-9d4f-e9c498a8859c'
-
-    recommendation_test.evaluate_recommendations(student_id, professor_id)
+    report = recommendation_test.evaluate(args.modes, args.relations, args.k, args.batch_size, args.latency_queries)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
@@ -0,0 +1,221 @@
+import bisect
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class NullTimer:
+    # Returned by a disabled registry so instrumented code pays for one call and nothing else.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class SamplingProfiler:
+    # Samples the Python stack of every other thread every interval seconds and counts
+    # identical stacks, so hot paths show up without instrumenting them up front.
+    def __init__(self, interval=0.005, max_depth=32):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.sample_count = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame, limit=self.max_depth)
+                self.samples[tuple(f"{os.path.basename(entry.filename)}:{entry.name}:{entry.lineno}" for entry in stack)] += 1
+                self.sample_count += 1
+
+    def top(self, n=20):
+        # Innermost frames (where the time is actually spent) with their share of the samples.
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack[-1]] += count
+        return [(frame, count, count / max(self.sample_count, 1)) for frame, count in leaves.most_common(n)]
+
+    def collapsed(self):
+        # One 'outer;...;inner count' line per stack, the input format of flame graph tools.
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.samples.most_common())
+
+
+class MetricsRegistry:
+    # Counters, gauges and histograms keyed by metric name plus label values. Everything
+    # is a no-op until enable() is called (or SCHOLARLINK_METRICS=1 is set).
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_callbacks = {}
+        self.histograms = {}
+        self.profiler = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge_callback(self, name, callback, **labels):
+        # Evaluated only when the metrics are exported, so it costs nothing on the query path.
+        with self.lock:
+            self.gauge_callbacks[(name, tuple(sorted(labels.items())))] = callback
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def lap(self, name, start, **labels):
+        # For hot paths: 't0 = registry.enabled and time.perf_counter()' costs one attribute
+        # check while disabled, and each 'if t0: t0 = registry.lap(...)' records a stage.
+        now = time.perf_counter()
+        self.observe(name, now - start, **labels)
+        return now
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def start_profiler(self, interval=0.005):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self):
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            profiler.stop()
+        return profiler
+
+    def export_prometheus(self):
+        def label_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = dict(self.gauges)
+            callbacks = list(self.gauge_callbacks.items())
+            histograms = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in self.histograms.items())
+
+        for key, callback in callbacks:
+            try:
+                gauges[key] = callback()
+            except Exception as e:
+                print(f"Error evaluating gauge {key[0]}: {e}")
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{label_text(labels)} {value}")
+
+        for (name, labels), value in sorted(gauges.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{label_text(labels)} {value}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # For the node_exporter textfile collector: written whole and renamed into place.
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            f.write(self.export_prometheus())
+        os.replace(tmp_path, path)
+
+
+# Shared by the engine, the data prep and the service in one process.
+registry = MetricsRegistry(enabled=os.environ.get('SCHOLARLINK_METRICS') == '1')
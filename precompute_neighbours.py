@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from embedding_store import load_embedding_store, load_guids, current_snapshot
+from recommendation_engine import ExactIndex, NEIGHBOUR_RELATIONS, guids_fingerprint, embeddings_fingerprint
+
+# Normalized matrices opened once per worker process from the memory-mapped embedding store.
+worker_embeddings = {}
+
+
+def init_worker(directory):
+    for entity in ('student', 'professor'):
+        _, worker_embeddings[entity] = load_embedding_store(f'{directory}/{entity}_embeddings.npy')
+
+
+def score_block(relation, start, stop, top_k, candidate_block_size):
+    query_entity, candidate_entity = NEIGHBOUR_RELATIONS[relation]
+    queries = np.asarray(worker_embeddings[query_entity][start:stop])
+    matches = ExactIndex(worker_embeddings[candidate_entity]).search_batch(
+        queries, top_k, block_size=len(queries), candidate_block_size=candidate_block_size)
+    return relation, start, np.stack([indices for indices, _ in matches]), np.stack([scores for _, scores in matches])
+
+
+def build_neighbour_tables(directory, top_k=100, block_size=1024, candidate_block_size=65536, workers=None):
+    # Exports the embedding stores up front so the workers only ever map existing files.
+    counts, fingerprints, vectors = {}, {}, {}
+    for entity in ('student', 'professor'):
+        _, embeddings = load_embedding_store(f'{directory}/{entity}_embeddings.npy')
+        guids, _ = load_guids(f'{directory}/{entity}_guids.json')
+        if len(guids) != len(embeddings):
+            raise ValueError(f"{entity} GUIDs and embeddings in {directory} are not aligned")
+        counts[entity] = len(guids)
+        fingerprints[entity] = guids_fingerprint(guids)
+        vectors[entity] = embeddings_fingerprint(f'{directory}/{entity}_embeddings.npy', len(guids))
+
+    staging = os.path.join(directory, f'.neighbours-staging-{os.getpid()}')
+    os.makedirs(staging)
+
+    # Outputs are preallocated on disk and filled block by block as workers finish.
+    outputs = {}
+    for relation, (query_entity, candidate_entity) in NEIGHBOUR_RELATIONS.items():
+        shape = (counts[query_entity], min(top_k, counts[candidate_entity]))
+        outputs[relation] = (
+            np.lib.format.open_memmap(os.path.join(staging, f'{relation}_indices.npy'), mode='w+', dtype=np.int32, shape=shape),
+            np.lib.format.open_memmap(os.path.join(staging, f'{relation}_scores.npy'), mode='w+', dtype=np.float32, shape=shape))
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(directory,)) as pool:
+        futures = [pool.submit(score_block, relation, start, min(start + block_size, counts[query_entity]), top_k, candidate_block_size)
+                   for relation, (query_entity, candidate_entity) in NEIGHBOUR_RELATIONS.items() if counts[candidate_entity]
+                   for start in range(0, counts[query_entity], block_size)]
+        for future in as_completed(futures):
+            relation, start, indices, scores = future.result()
+            outputs[relation][0][start:start + len(indices)] = indices
+            outputs[relation][1][start:start + len(scores)] = scores
+
+    for indices, scores in outputs.values():
+        indices.flush()
+        scores.flush()
+
+    manifest = {'built_at': time.time(), 'top_k': top_k,
+                'students': {'count': counts['student'], 'guids_sha1': fingerprints['student'], 'embeddings_sha1': vectors['student']},
+                'professors': {'count': counts['professor'], 'guids_sha1': fingerprints['professor'],
+                               'embeddings_sha1': vectors['professor']}}
+    with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    # Swap the finished tables into place; engines that already mapped the old files keep them.
+    target = os.path.join(directory, 'neighbours')
+    if os.path.exists(target):
+        retired = f'{target}.old-{os.getpid()}'
+        os.rename(target, retired)
+        os.rename(staging, target)
+        shutil.rmtree(retired, ignore_errors=True)
+    else:
+        os.rename(staging, target)
+
+    print(f"Built top-{top_k} neighbour tables for {counts['student']} students and {counts['professor']} professors "
+          f"in {time.time() - start_time:.1f} seconds")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute top-k neighbour tables for the recommendation engine")
+    parser.add_argument('--data-path', default='./data/recommender_data')
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--candidate-block-size', type=int, default=65536)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    # Tables are written into the current snapshot when one has been published.
+    directory = args.data_path
+    if os.path.exists(f'{args.data_path}/snapshots/CURRENT'):
+        directory, _ = current_snapshot(f'{args.data_path}/snapshots')
+
+    build_neighbour_tables(directory, args.top_k, args.block_size, args.candidate_block_size, args.workers)
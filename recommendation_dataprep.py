@@ -1,17 +1,57 @@
 import os
+import sys
+import argparse
+import hashlib
 import numpy as np
 import json
 import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import torch
 from sentence_transformers import SentenceTransformer
 import pandas as pd
+from pandas.api.types import union_categoricals
+from embedding_store import export_embedding_store, export_guid_index, IncrementalEmbeddingStore, EmbeddingCache, publish_snapshot, replace_files, write_metadata, FIELD_COLUMN
+from metrics import registry
+from precompute_neighbours import build_neighbour_tables
+
+# Model instance of a streaming encoder worker process (see RecommenderDataPrep.stream_embeddings).
+encoder_model = None
+
+
+def init_encoder(model_name, threads):
+    global encoder_model
+    torch.set_num_threads(threads)
+    encoder_model = SentenceTransformer(model_name)
+
+
+def encoder_dimension():
+    return encoder_model.get_sentence_embedding_dimension()
+
+
+def encode_texts(texts, batch_size):
+    return encoder_model.encode(texts, batch_size=batch_size)
+
 
 class RecommenderDataPrep:
-    def __init__(self, students_data_path, professors_data_path, data_download_path, model_name='paraphrase-MiniLM-L6-v2'):
+    def __init__(self, students_data_path, professors_data_path, data_download_path, model_name='paraphrase-MiniLM-L6-v2',
+                 cache_size=100000, neighbour_top_k=0):
         self.students_data_path = students_data_path
         self.professors_data_path = professors_data_path
         self.data_download_path = data_download_path
-        self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.loaded_model = None
         self.last_timestamp = None
+        # One cache serves both the student and professor passes.
+        self.cache = EmbeddingCache(f'{data_download_path}/embedding_cache.npz', cache_size, model=model_name)
+        # When set, every published snapshot ships with neighbour tables built from its own vectors.
+        self.neighbour_top_k = neighbour_top_k
+
+    @property
+    def model(self):
+        # Loaded on first use; the streaming build encodes in worker processes instead.
+        if self.loaded_model is None:
+            self.loaded_model = SentenceTransformer(self.model_name)
+        return self.loaded_model
 
     def get_file_timestamp(self, path):
         try:
@@ -46,8 +86,9 @@ class RecommenderDataPrep:
 
     def create_embeddings(self, students, professors, existing_student_embeddings=None, existing_professor_embeddings=None):
         try:
-            student_embeddings = self.model.encode(students['Research Interests'].tolist())
-            professor_embeddings = self.model.encode(professors['Research Interests'].tolist())
+            student_embeddings = self.encode(students['Research Interests'].tolist())
+            professor_embeddings = self.encode(professors['Research Interests'].tolist())
+            self.cache.save()
             
             if existing_student_embeddings is not None:
                 student_embeddings = np.concatenate([existing_student_embeddings, student_embeddings], axis=0)
@@ -60,59 +101,296 @@ class RecommenderDataPrep:
             print(f"Error creating embeddings: {e}")
             return None, None
 
-    def save_embeddings_and_guids(self, student_embeddings, professor_embeddings, student_guids, professor_guids):
+    def canonical_text(self, text):
+        # clean_text de-duplicates through a set, so its term order is not stable across
+        # processes; the sorted terms give one spelling per set of interests.
+        return ",".join(sorted(set(item.strip() for item in text.split(','))))
+
+    def canonical_hash(self, canonical):
+        # Keyed by model as well, so switching models re-encodes cached texts and stored rows.
+        return hashlib.sha1(f"{self.model_name}\n{canonical}".encode('utf-8')).hexdigest()
+
+    def content_hash(self, text):
+        return self.canonical_hash(self.canonical_text(text))
+
+    def encode(self, texts):
+        # Texts are reduced to their canonical form and de-duplicated, and only those not
+        # already in the cache are sent to the model. The cache is saved by the caller,
+        # once per build or reload.
+        canonical_texts = [self.canonical_text(text) for text in texts]
+        keys = [self.canonical_hash(canonical) for canonical in canonical_texts]
+        canonical = dict(zip(keys, canonical_texts))
+
+        unique_keys = list(canonical)
+        vectors = dict(zip(unique_keys, self.cache.get_many(unique_keys)))
+        missing = [key for key, vector in vectors.items() if vector is None]
+        registry.inc('dataprep_embedding_cache_hits_total', len(unique_keys) - len(missing))
+        registry.inc('dataprep_embedding_cache_misses_total', len(missing))
+
+        if missing:
+            start = time.perf_counter()
+            encoded = self.model.encode([canonical[key] for key in missing])
+            elapsed = time.perf_counter() - start
+            registry.observe('dataprep_encode_seconds', elapsed)
+            registry.inc('dataprep_texts_encoded_total', len(missing))
+            registry.set_gauge('dataprep_encode_texts_per_second', len(missing) / max(elapsed, 1e-9))
+            vectors.update(zip(missing, encoded))
+            self.cache.put_many(missing, encoded)
+
+        return np.stack([vectors[key] for key in keys])
+
+    def update_store(self, store, data, guid_column):
+        try:
+            guids = data[guid_column].tolist()
+            content_hashes = data['Research Interests'].apply(self.content_hash).tolist()
+            changed, deleted = store.diff(guids, content_hashes)
+
+            # Only new and edited rows go through the model.
+            changed_rows = data[changed]
+            if len(changed_rows):
+                embeddings = self.encode(changed_rows['Research Interests'].tolist())
+                store.upsert(changed_rows[guid_column].tolist(), [h for h, c in zip(content_hashes, changed) if c], embeddings)
+            store.delete(deleted)
+
+            registry.inc('dataprep_rows_upserted_total', int(changed.sum()), store=os.path.basename(store.path))
+            registry.inc('dataprep_rows_deleted_total', len(deleted), store=os.path.basename(store.path))
+            return int(changed.sum()), len(deleted)
+        except Exception as e:
+            print(f"Error updating embedding store {store.path}: {e}")
+            return None, None
+
+    def stream_embeddings(self, directory, data_path, guid_column, entity, chunk_size=100000, batch_size=256,
+                          workers=None, metadata_columns=(FIELD_COLUMN,)):
+        # First pass: only the GUIDs and low-cardinality metadata columns are kept in memory.
+        guids, metadata = [], []
+        for chunk in pd.read_csv(data_path, usecols=[guid_column, *metadata_columns], chunksize=chunk_size):
+            guids.extend(chunk[guid_column].tolist())
+            metadata.append(chunk[list(metadata_columns)].astype('category'))
+
+        build_start = time.perf_counter()
+        encoded = 0
+        workers = workers or os.cpu_count()
+        threads = max(1, os.cpu_count() // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_encoder, initargs=(self.model_name, threads)) as pool:
+            dimension = pool.submit(encoder_dimension).result()
+            embeddings = np.lib.format.open_memmap(f'{directory}/{entity}_embeddings.npy', mode='w+',
+                                                   dtype=np.float32, shape=(len(guids), dimension))
+
+            # Texts waiting on a worker, keyed by content hash, with every row that needs them.
+            pending, inflight_rows = {}, {}
+
+            def collect(futures):
+                nonlocal encoded
+                for future in futures:
+                    keys = pending.pop(future)
+                    vectors = future.result()
+                    self.cache.put_many(keys, vectors)
+                    encoded += len(keys)
+                    for key, vector in zip(keys, vectors):
+                        embeddings[inflight_rows.pop(key)] = vector
+
+            # Second pass: the texts are streamed chunk by chunk. Cached texts are written
+            # straight away; the rest are sorted by length so each batch has similar-length
+            # texts (less padding) and sent to the workers with a bounded number in flight.
+            offset = 0
+            for chunk in pd.read_csv(data_path, usecols=['Research Interests'], chunksize=chunk_size):
+                rows_by_key, text_by_key = {}, {}
+                for row, text in enumerate(chunk['Research Interests'].tolist(), start=offset):
+                    key = self.content_hash(text)
+                    if key in inflight_rows:
+                        inflight_rows[key].append(row)
+                    elif key in rows_by_key:
+                        rows_by_key[key].append(row)
+                    else:
+                        rows_by_key[key] = [row]
+                        text_by_key[key] = self.canonical_text(text)
+                offset += len(chunk)
+
+                keys = list(rows_by_key)
+                missing = []
+                for key, vector in zip(keys, self.cache.get_many(keys)):
+                    if vector is None:
+                        missing.append(key)
+                        inflight_rows[key] = rows_by_key[key]
+                    else:
+                        embeddings[rows_by_key[key]] = vector
+                registry.inc('dataprep_embedding_cache_hits_total', len(keys) - len(missing))
+                registry.inc('dataprep_embedding_cache_misses_total', len(missing))
+
+                missing.sort(key=lambda key: len(text_by_key[key].split()))
+                for start in range(0, len(missing), batch_size):
+                    batch = missing[start:start + batch_size]
+                    if len(pending) >= 2 * workers:
+                        collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                    pending[pool.submit(encode_texts, [text_by_key[key] for key in batch], batch_size)] = batch
+
+            collect(list(pending))
+            embeddings.flush()
+
+        self.cache.save()
+
+        with open(f'{directory}/{entity}_guids.json', 'w') as f:
+            json.dump(guids, f)
+        export_guid_index(f'{directory}/{entity}_guids.json', guids)
+
+        if metadata:
+            columns = {column: union_categoricals([frame[column] for frame in metadata]) for column in metadata_columns}
+            write_metadata(f'{directory}/{entity}_metadata.npz', pd.DataFrame(columns))
+
+        export_embedding_store(f'{directory}/{entity}_embeddings.npy', embeddings)
+
+        elapsed = time.perf_counter() - build_start
+        registry.observe('dataprep_build_seconds', elapsed, entity=entity)
+        registry.inc('dataprep_texts_encoded_total', encoded)
+        registry.set_gauge('dataprep_encode_texts_per_second', encoded / max(elapsed, 1e-9), entity=entity)
+        return len(guids)
+
+    def build_embeddings_streaming(self, chunk_size=100000, batch_size=256, workers=None):
+        # Streams both CSVs straight into a new snapshot directory; nothing is held in
+        # memory beyond the GUID lists, one chunk of text and the batches in flight.
+        counts = {}
+
+        def write_files(directory):
+            counts['students'] = self.stream_embeddings(directory, self.students_data_path, 'Student GUID', 'student',
+                                                        chunk_size, batch_size, workers)
+            counts['professors'] = self.stream_embeddings(directory, self.professors_data_path, 'Professor GUID', 'professor',
+                                                          chunk_size, batch_size, workers)
+            self.write_neighbour_tables(directory)
+
         try:
-            with open(f'{self.data_download_path}/student_embeddings.npy', 'wb') as f:
-                np.save(f, student_embeddings)
+            version = publish_snapshot(f'{self.data_download_path}/snapshots', write_files, counts)
+            print(f"Published snapshot {version}: {counts['students']} students, {counts['professors']} professors")
+            return version
+        except Exception as e:
+            print(f"Error building embeddings: {e}")
+            return None
+
+    def metadata_columns(self, data, guid_column, guids):
+        # Non-text columns, row-aligned with the given GUID order, for the metadata sidecar.
+        return data.set_index(guid_column).loc[guids].drop(columns=['Research Interests']).reset_index(drop=True)
+
+    def write_embeddings_and_guids(self, directory, student_embeddings, professor_embeddings, student_guids, professor_guids,
+                                   student_metadata=None, professor_metadata=None):
+        with open(f'{directory}/student_embeddings.npy', 'wb') as f:
+            np.save(f, student_embeddings)
 
-            with open(f'{self.data_download_path}/professor_embeddings.npy', 'wb') as f:
-                np.save(f, professor_embeddings)
+        with open(f'{directory}/professor_embeddings.npy', 'wb') as f:
+            np.save(f, professor_embeddings)
 
-            with open(f'{self.data_download_path}/student_guids.json', 'w') as f:
-                json.dump(student_guids, f)
+        with open(f'{directory}/student_guids.json', 'w') as f:
+            json.dump(student_guids, f)
 
-            with open(f'{self.data_download_path}/professor_guids.json', 'w') as f:
-                json.dump(professor_guids, f)
+        with open(f'{directory}/professor_guids.json', 'w') as f:
+            json.dump(professor_guids, f)
+
+        # Binary GUID indexes the engine maps instead of parsing the JSON lists.
+        export_guid_index(f'{directory}/student_guids.json', student_guids)
+        export_guid_index(f'{directory}/professor_guids.json', professor_guids)
+
+        export_embedding_store(f'{directory}/student_embeddings.npy', student_embeddings)
+        export_embedding_store(f'{directory}/professor_embeddings.npy', professor_embeddings)
+
+        if student_metadata is not None:
+            write_metadata(f'{directory}/student_metadata.npz', student_metadata)
+
+        if professor_metadata is not None:
+            write_metadata(f'{directory}/professor_metadata.npz', professor_metadata)
+
+    def write_neighbour_tables(self, directory):
+        # Runs inside the staging directory, before the snapshot is published.
+        if self.neighbour_top_k:
+            build_neighbour_tables(directory, self.neighbour_top_k)
+
+    def save_embeddings_and_guids(self, student_embeddings, professor_embeddings, student_guids, professor_guids,
+                                  student_metadata=None, professor_metadata=None):
+        try:
+            replace_files(self.data_download_path,
+                          lambda directory: self.write_embeddings_and_guids(directory, student_embeddings, professor_embeddings,
+                                                                            student_guids, professor_guids,
+                                                                            student_metadata, professor_metadata))
+
+            # The same data is also published as an atomic, versioned snapshot that running
+            # engines pick up through ScholarlinkRecommendationEngine.watch_snapshots.
+            def write_files(directory):
+                self.write_embeddings_and_guids(directory, student_embeddings, professor_embeddings, student_guids, professor_guids,
+                                                student_metadata, professor_metadata)
+                self.write_neighbour_tables(directory)
+
+            version = publish_snapshot(f'{self.data_download_path}/snapshots', write_files,
+                                       {'students': len(student_guids), 'professors': len(professor_guids)})
+            print(f"Published snapshot {version}")
         except Exception as e:
             print(f"Error saving embeddings and GUIDs: {e}")
 
-
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate GUIDs and embeddings for students and professors")
+    parser.add_argument('--streaming', action='store_true', help="One-off chunked, multi-process build into a new snapshot")
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--neighbour-top-k', type=int, default=0,
+                        help="Precompute top-k neighbour tables into every published snapshot (0: off)")
+    parser.add_argument('--metrics-file', help="Write Prometheus metrics here after every build (textfile collector)")
+    args = parser.parse_args()
+    if args.metrics_file:
+        registry.enable()
+
     students_data_path = './data/raw/students.csv'
     professors_data_path = './data/raw/professors.csv'
     data_download_path = './data/recommender_data'
 
-    data_prep = RecommenderDataPrep(students_data_path, professors_data_path, data_download_path)
+    data_prep = RecommenderDataPrep(students_data_path, professors_data_path, data_download_path,
+                                    neighbour_top_k=args.neighbour_top_k)
+
+    if args.streaming:
+        version = data_prep.build_embeddings_streaming(args.chunk_size, args.batch_size, args.workers)
+        if args.metrics_file:
+            registry.write_prometheus(args.metrics_file)
+        sys.exit(0 if version is not None else 1)
+    student_store = IncrementalEmbeddingStore(f'{data_download_path}/student_store')
+    professor_store = IncrementalEmbeddingStore(f'{data_download_path}/professor_store')
 
     while True:
         if data_prep.is_updated():
             print("Dataset updated. Reloading data and updating embeddings...")
+            reload_start = time.time()
             
             students, professors = data_prep.load_data()
 
             if students is not None and professors is not None:
                 print("Data loaded successfully.")
 
-                existing_student_embeddings = None
-                existing_professor_embeddings = None
-                
-                if os.path.exists(f'{data_download_path}/student_embeddings.npy'):
-                    existing_student_embeddings = np.load(f'{data_download_path}/student_embeddings.npy')
-                
-                if os.path.exists(f'{data_download_path}/professor_embeddings.npy'):
-                    existing_professor_embeddings = np.load(f'{data_download_path}/professor_embeddings.npy')
+                student_changes = data_prep.update_store(student_store, students, 'Student GUID')
+                professor_changes = data_prep.update_store(professor_store, professors, 'Professor GUID')
+                data_prep.cache.save()
 
-                student_embeddings, professor_embeddings = data_prep.create_embeddings(students, professors, existing_student_embeddings, existing_professor_embeddings)
+                if None not in student_changes and None not in professor_changes:
+                    print(f"Embeddings updated successfully: students {student_changes[0]} upserted, {student_changes[1]} deleted; "
+                          f"professors {professor_changes[0]} upserted, {professor_changes[1]} deleted.")
 
-                if student_embeddings is not None and professor_embeddings is not None:
-                    print("Embeddings updated successfully.")
+                    student_guids, student_embeddings = student_store.materialize()
+                    professor_guids, professor_embeddings = professor_store.materialize()
 
-                    student_guids = students['Student GUID'].tolist()
-                    professor_guids = professors['Professor GUID'].tolist()
+                    student_metadata = data_prep.metadata_columns(students, 'Student GUID', student_guids)
+                    professor_metadata = data_prep.metadata_columns(professors, 'Professor GUID', professor_guids)
 
-                    data_prep.save_embeddings_and_guids(student_embeddings, professor_embeddings, student_guids, professor_guids)
+                    data_prep.save_embeddings_and_guids(student_embeddings, professor_embeddings, student_guids, professor_guids,
+                                                        student_metadata, professor_metadata)
 
                     print("Updated embeddings and GUIDs saved successfully.")
+                    # Lag from the CSVs changing on disk to the new snapshot being published.
+                    changed_at = max(data_prep.get_file_timestamp(students_data_path) or 0,
+                                     data_prep.get_file_timestamp(professors_data_path) or 0)
+                    registry.observe('dataprep_reload_seconds', time.time() - reload_start)
+                    registry.set_gauge('dataprep_reload_lag_seconds', time.time() - changed_at)
+                    registry.set_gauge('dataprep_rows', len(student_guids), entity='student')
+                    registry.set_gauge('dataprep_rows', len(professor_guids), entity='professor')
+                    if args.metrics_file:
+                        registry.write_prometheus(args.metrics_file)
+                    print(f"Embedding cache: {data_prep.cache.stats()}")
+
+                    student_store.compact_in_background()
+                    professor_store.compact_in_background()
                 else:
                     print("Failed to update embeddings.")
             else:
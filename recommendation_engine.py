@@ -1,104 +1,1159 @@
+import os
+import sys
+import hashlib
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 import json
 import pandas as pd
 import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from embedding_store import load_embedding_store, source_fingerprint, load_guids, current_snapshot, snapshot_paths, metadata_path, MetadataColumns, FIELD_COLUMN
+from metrics import registry
 
-class ScholarlinkRecommendationEngine:
-    def __init__(self, student_embeddings_path, professor_embeddings_path, 
-                 student_guids_path, professor_guids_path):
-        try:
-            with open(student_embeddings_path, 'rb') as f:
-                self.student_embeddings = np.load(f)
+# Histogram of the time spent in each step of a query: lookup, table, probe, similarity, gather, top_k, rerank, format.
+STAGE_SECONDS = 'recommendation_stage_seconds'
 
-            with open(professor_embeddings_path, 'rb') as f:
-                self.professor_embeddings = np.load(f)
 
-            with open(student_guids_path, 'r') as f:
-                self.student_guids = json.load(f)
+def top_n_indices(sim_scores, top_n):
+    # Works row-wise on 2-D score blocks as well as on a single score vector.
+    n = sim_scores.shape[-1]
+    if 0 < top_n < n:
+        indices = np.argpartition(sim_scores, -top_n, axis=-1)[..., -top_n:]
+    else:
+        indices = np.broadcast_to(np.arange(n), sim_scores.shape)
+    order = np.argsort(np.take_along_axis(sim_scores, indices, axis=-1), axis=-1)[..., ::-1]
+    return np.take_along_axis(indices, order, axis=-1)
 
-            with open(professor_guids_path, 'r') as f:
-                self.professor_guids = json.load(f)
-        except FileNotFoundError as e:
-            print(f"Error: {e}")
-            raise
 
-    def recommend_professors(self, student_id, top_n=10, threshold=0.90):
+def search_rows(embeddings, rows, query, top_n):
+    t0 = registry.enabled and time.perf_counter()
+    sim_scores = embeddings[rows] @ query
+    if t0:
+        t0 = registry.lap(STAGE_SECONDS, t0, stage='similarity')
+    indices = top_n_indices(sim_scores, top_n)
+    if t0:
+        registry.lap(STAGE_SECONDS, t0, stage='top_k')
+    return rows[indices], sim_scores[indices]
+
+
+def search_rows_batch(embeddings, rows, queries, top_n, block_size=256, candidate_block_size=65536):
+    matches = ExactIndex(embeddings[rows]).search_batch(queries, top_n, block_size, candidate_block_size)
+    return [(rows[indices], sim_scores) for indices, sim_scores in matches]
+
+
+class ExactIndex:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query, top_n, **search_params):
+        t0 = registry.enabled and time.perf_counter()
+        sim_scores = self.embeddings @ query
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='similarity')
+        indices = top_n_indices(sim_scores, top_n)
+        if t0:
+            registry.lap(STAGE_SECONDS, t0, stage='top_k')
+        return indices, sim_scores[indices]
+
+    def search_batch(self, queries, top_n, block_size=256, candidate_block_size=65536, **search_params):
+        results = []
+
+        # Queries are scored block by block against slices of the candidate matrix and only a
+        # running top-n per query is kept, so at most block_size x candidate_block_size scores
+        # are held in memory at any time.
+        for query_start in range(0, len(queries), block_size):
+            block = queries[query_start:query_start + block_size]
+            best_scores, best_indices = None, None
+
+            for candidate_start in range(0, len(self.embeddings), candidate_block_size):
+                candidates = self.embeddings[candidate_start:candidate_start + candidate_block_size]
+                t0 = registry.enabled and time.perf_counter()
+                sim_scores = block @ candidates.T
+                if t0:
+                    t0 = registry.lap(STAGE_SECONDS, t0, stage='similarity')
+
+                indices = top_n_indices(sim_scores, top_n)
+                sim_scores = np.take_along_axis(sim_scores, indices, axis=1)
+                indices = indices + candidate_start
+
+                if best_scores is not None:
+                    sim_scores = np.hstack([best_scores, sim_scores])
+                    indices = np.hstack([best_indices, indices])
+                    order = top_n_indices(sim_scores, top_n)
+                    sim_scores = np.take_along_axis(sim_scores, order, axis=1)
+                    indices = np.take_along_axis(indices, order, axis=1)
+                if t0:
+                    registry.lap(STAGE_SECONDS, t0, stage='top_k')
+
+                best_scores, best_indices = sim_scores, indices
+
+            if best_scores is None:
+                results.extend((np.empty(0, dtype=np.int64), np.empty(0, dtype=self.embeddings.dtype)) for _ in block)
+            else:
+                results.extend(zip(best_indices, best_scores))
+
+        return results
+
+
+class IVFIndex:
+    # Inverted-file index: rows are bucketed by their nearest k-means centroid and a query
+    # only scans the nprobe buckets whose centroids are closest to it. Raising nprobe trades
+    # latency for recall; nprobe == n_lists is an exact scan.
+    def __init__(self, embeddings, centroids, list_offsets, list_rows, nprobe=8):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=10, sample_size=100000, nprobe=8, seed=0):
+        rng = np.random.default_rng(seed)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(embeddings))))
+        n_lists = min(n_lists, len(embeddings))
+
+        sample = embeddings
+        if len(embeddings) > sample_size:
+            sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))]
+
+        # Spherical k-means: centroids are kept at unit length so assignment is a dot product.
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = cls.assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = normalize(sums)
+
+        assignments = cls.assign(embeddings, centroids)
+        list_rows = np.argsort(assignments, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(embeddings, centroids, list_offsets, list_rows, nprobe)
+
+    @staticmethod
+    def assign(embeddings, centroids, block_size=65536):
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), block_size):
+            assignments[start:start + block_size] = np.argmax(embeddings[start:start + block_size] @ centroids.T, axis=1)
+        return assignments
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.list_offsets.nbytes + self.list_rows.nbytes
+
+    def save(self, path, source=''):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows, source=source)
+
+    @classmethod
+    def load(cls, path, embeddings, nprobe=8, source=''):
+        # Lists built over older vectors would silently misfile rows, even at the same shape.
+        with np.load(path) as data:
+            if 'source' not in data.files or str(data['source']) != source:
+                raise ValueError(f"IVF index {path} was built from different embeddings")
+            index = cls(embeddings, data['centroids'], data['list_offsets'], data['list_rows'], nprobe)
+        if len(index.list_rows) != len(embeddings) or index.centroids.shape[1] != embeddings.shape[1]:
+            raise ValueError(f"IVF index {path} does not match the embeddings it was loaded with")
+        return index
+
+    def search(self, query, top_n, nprobe=None, **search_params):
+        t0 = registry.enabled and time.perf_counter()
+        probes = top_n_indices(self.centroids @ query, nprobe or self.nprobe)
+        rows = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='probe')
+        sim_scores = self.embeddings[rows] @ query
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='similarity')
+        indices = top_n_indices(sim_scores, top_n)
+        if t0:
+            registry.lap(STAGE_SECONDS, t0, stage='top_k')
+        return rows[indices], sim_scores[indices]
+
+    def search_batch(self, queries, top_n, nprobe=None, **search_params):
+        return [self.search(query, top_n, nprobe) for query in queries]
+
+
+class CompressedIndex:
+    # Scans a compact copy of the normalized matrix for a shortlist of rerank x top_n rows per
+    # query, then scores only those rows against the float32 vectors: returned scores, and so
+    # the thresholds applied to them, are exact, and only top-n membership can differ from an
+    # exact scan. Codes are float16, or int8 with a per-dimension scale, optionally after a
+    # PCA projection fitted at build time. Subclasses below pick the codec; the PCA ones
+    # shortlist more rows since the projection drops more of each score than rounding does.
+    dtype = np.float16
+    components = None
+    rerank = 10
+
+    def __init__(self, embeddings, codes, scales=None, projection=None, rerank=None, scan_block_size=4096):
+        self.embeddings = embeddings
+        self.codes = codes
+        self.scales = scales
+        self.projection = projection
+        self.rerank = rerank or self.rerank
+        self.scan_block_size = scan_block_size
+
+    @classmethod
+    def build(cls, embeddings, components=None, sample_size=100000, rerank=None, seed=0, block_size=65536, **build_params):
+        components = components or cls.components
+        projection = None
+        if components and len(embeddings):
+            rng = np.random.default_rng(seed)
+            sample = embeddings
+            if len(embeddings) > sample_size:
+                sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))]
+            sample = np.asarray(sample, dtype=np.float32)
+            # Leading eigenvectors of the sample covariance. Codes are projected without
+            # centring: the mean only adds the same q . mean to every candidate's score.
+            centred = sample - sample.mean(axis=0)
+            eigenvalues, eigenvectors = np.linalg.eigh(centred.T @ centred)
+            projection = np.ascontiguousarray(eigenvectors[:, ::-1][:, :min(components, sample.shape[1])], dtype=np.float32)
+
+        index = cls(embeddings, None, None, projection, rerank)
+        width = projection.shape[1] if projection is not None else embeddings.shape[1]
+        if cls.dtype == np.int8:
+            max_abs = np.zeros(width, dtype=np.float32)
+            for start in range(0, len(embeddings), block_size):
+                max_abs = np.maximum(max_abs, np.abs(index.project(embeddings[start:start + block_size])).max(axis=0))
+            index.scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+
+        index.codes = np.empty((len(embeddings), width), dtype=cls.dtype)
+        for start in range(0, len(embeddings), block_size):
+            index.codes[start:start + block_size] = index.encode(embeddings[start:start + block_size])
+        return index
+
+    def project(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors @ self.projection if self.projection is not None else vectors
+
+    def encode(self, vectors):
+        vectors = self.project(vectors)
+        if self.scales is not None:
+            return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+        return vectors.astype(self.dtype)
+
+    def encode_queries(self, queries):
+        # Folds the int8 scales into the queries, so codes are only widened, never rescaled.
+        queries = self.project(queries)
+        return queries * self.scales if self.scales is not None else queries
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.codes, self.scales, self.projection) if array is not None)
+
+    def save(self, path, source=''):
+        with open(path, 'wb') as f:
+            np.savez(f, codes=self.codes, rerank=self.rerank, source=source,
+                     scales=self.scales if self.scales is not None else np.empty(0, dtype=np.float32),
+                     projection=self.projection if self.projection is not None else np.empty((0, 0), dtype=np.float32))
+
+    @classmethod
+    def load(cls, path, embeddings, nprobe=8, source=''):
+        with np.load(path) as data:
+            if 'source' not in data.files or str(data['source']) != source:
+                raise ValueError(f"{cls.__name__} {path} was built from different embeddings")
+            scales = data['scales'] if data['scales'].size else None
+            projection = data['projection'] if data['projection'].size else None
+            index = cls(embeddings, data['codes'], scales, projection, int(data['rerank']))
+        width = projection.shape[0] if projection is not None else index.codes.shape[1]
+        if len(index.codes) != len(embeddings) or width != embeddings.shape[1] or index.codes.dtype != cls.dtype:
+            raise ValueError(f"{cls.__name__} {path} does not match the embeddings it was loaded with")
+        return index
+
+    def scan(self, queries, width):
+        # Running top-width of the compressed scores per query, one widened block of codes at a time.
+        best_scores, best_indices = None, None
+        block = np.empty((min(self.scan_block_size, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+        for candidate_start in range(0, len(self.codes), self.scan_block_size):
+            codes = self.codes[candidate_start:candidate_start + self.scan_block_size]
+            candidates = block[:len(codes)]
+            candidates[...] = codes
+            sim_scores = queries @ candidates.T
+            indices = top_n_indices(sim_scores, width)
+            sim_scores = np.take_along_axis(sim_scores, indices, axis=1)
+            indices = indices + candidate_start
+            if best_scores is not None:
+                sim_scores = np.hstack([best_scores, sim_scores])
+                indices = np.hstack([best_indices, indices])
+                order = top_n_indices(sim_scores, width)
+                sim_scores = np.take_along_axis(sim_scores, order, axis=1)
+                indices = np.take_along_axis(indices, order, axis=1)
+            best_scores, best_indices = sim_scores, indices
+        if best_indices is None:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        return best_indices
+
+    def search_batch(self, queries, top_n, block_size=256, **search_params):
+        results = []
+        for query_start in range(0, len(queries), block_size):
+            block = np.asarray(queries[query_start:query_start + block_size], dtype=np.float32)
+            t0 = registry.enabled and time.perf_counter()
+            shortlist = self.scan(self.encode_queries(block), max(top_n, 1) * self.rerank)
+            if t0:
+                t0 = registry.lap(STAGE_SECONDS, t0, stage='similarity')
+
+            # Exact float32 scores for the shortlisted rows only; rows are gathered in sorted
+            # order so memory-mapped matrices are read front to back.
+            rows = np.unique(shortlist)
+            candidates = np.asarray(self.embeddings[rows])
+            sim_scores = np.einsum('qkd,qd->qk', candidates[np.searchsorted(rows, shortlist)], block)
+            order = top_n_indices(sim_scores, top_n)
+            if t0:
+                registry.lap(STAGE_SECONDS, t0, stage='rerank')
+            results.extend(zip(np.take_along_axis(shortlist, order, axis=1), np.take_along_axis(sim_scores, order, axis=1)))
+        return results
+
+    def search(self, query, top_n, **search_params):
+        return self.search_batch(query[None, :], top_n)[0]
+
+
+class Float16Index(CompressedIndex):
+    dtype = np.float16
+
+
+class Int8Index(CompressedIndex):
+    dtype = np.int8
+
+
+class PCAIndex(CompressedIndex):
+    dtype = np.float16
+    components = 128
+    rerank = 50
+
+
+class PCAInt8Index(CompressedIndex):
+    dtype = np.int8
+    components = 128
+    rerank = 50
+
+
+# Set to 1 in shard workers: the shards already keep every core busy between them.
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def shard_bounds(count, shards):
+    edges = np.linspace(0, count, shards + 1).astype(np.int64)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def shard_worker(connection, source, start, stop):
+    # Serves one contiguous row range of a candidate matrix. Requests and replies are plain
+    # picklable tuples over a multiprocessing Connection, so the same loop can serve a shard
+    # from another host behind a multiprocessing.connection.Listener.
+    kind, name, dtype, shape, offset = source
+    block = None
+    try:
+        if kind == 'shm':
+            block = shared_memory.SharedMemory(name=name)
+            embeddings = np.ndarray(shape, dtype=dtype, buffer=block.buf)[start:stop]
+        else:
+            embeddings = np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape)[start:stop]
+        index = ExactIndex(embeddings)
+        connection.send(('ready', stop - start))
+    except Exception as e:
+        connection.send(('error', f"Error attaching shard {start}:{stop}: {e}"))
+        return
+
+    try:
+        while True:
+            request = connection.recv()
+            if request[0] == 'close':
+                break
+            _, queries, top_n, block_size, candidate_block_size = request
+            try:
+                matches = index.search_batch(queries, top_n, block_size, candidate_block_size)
+                connection.send((np.stack([indices for indices, _ in matches]) + start,
+                                 np.stack([sim_scores for _, sim_scores in matches])))
+            except Exception as e:
+                connection.send(('error', f"Error searching shard {start}:{stop}: {e}"))
+    except EOFError:
+        pass
+    finally:
+        # The views must go before the shared memory block can be closed.
+        del index, embeddings
+        if block is not None:
+            block.close()
+        connection.close()
+
+
+class ShardedIndex:
+    # Exact search scattered over worker processes, each owning a contiguous row range of the
+    # candidate matrix. Every shard returns its local top-n for the query block and the parent
+    # merges them, so a single query is scored on all cores. In-memory matrices are copied once
+    # into shared memory; memory-mapped stores are reopened by path in each worker.
+    def __init__(self, embeddings, shards=None):
+        self.shards = max(1, min(shards or os.cpu_count() or 1, len(embeddings)))
+        self.lock = threading.Lock()
+        self.connections = []
+        self.processes = []
+        self.block = None
+        if isinstance(embeddings, np.memmap) and embeddings.filename:
+            source = ('file', embeddings.filename, embeddings.dtype.str, embeddings.shape, embeddings.offset)
+        else:
+            self.block = shared_memory.SharedMemory(create=True, size=max(embeddings.nbytes, 1))
+            shared = np.ndarray(embeddings.shape, dtype=embeddings.dtype, buffer=self.block.buf)
+            shared[:] = embeddings
+            embeddings = shared
+            source = ('shm', self.block.name, embeddings.dtype.str, embeddings.shape, 0)
+        self.embeddings = embeddings
+
+        context = multiprocessing.get_context('spawn')
+        saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+        os.environ.update(dict.fromkeys(BLAS_THREAD_VARIABLES, '1'))
         try:
-            student_index = self.student_guids.index(student_id)
-            student_embedding = self.student_embeddings[student_index].reshape(1, -1)
-
-            sim_scores = cosine_similarity(student_embedding, self.professor_embeddings)
-            
-            indices = np.argsort(sim_scores[0])[-top_n:][::-1]
-            
-            mask = sim_scores[0, indices] > threshold
-            filtered_indices = indices[mask]
-            
-            recommended_professors = [(self.professor_guids[i], sim_scores[0, i]*100) for i in filtered_indices]
-            
-            return recommended_professors
-        except ValueError as e:
-            print(f"Error: {e}")
-            return []
+            for start, stop in shard_bounds(len(embeddings), self.shards):
+                connection, child_connection = context.Pipe()
+                process = context.Process(target=shard_worker, args=(child_connection, source, start, stop), daemon=True)
+                process.start()
+                child_connection.close()
+                self.connections.append(connection)
+                self.processes.append(process)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
 
-    def recommend_students(self, professor_id, top_n=10, threshold=0.90):
         try:
-            professor_index = self.professor_guids.index(professor_id)
-            professor_embedding = self.professor_embeddings[professor_index].reshape(1, -1)
-            
-            sim_scores = cosine_similarity(professor_embedding, self.student_embeddings)
-            
-            indices = np.argsort(sim_scores[0])[-top_n:][::-1]
-            
-            mask = sim_scores[0, indices] > threshold
-            filtered_indices = indices[mask]
-            
-            recommended_students = [(self.student_guids[i], sim_scores[0, i]*100) for i in filtered_indices]
-            
-            return recommended_students
-        except ValueError as e:
-            print(f"Error: {e}")
+            replies = [connection.recv() for connection in self.connections]
+            for reply in replies:
+                if reply[0] == 'error':
+                    raise RuntimeError(reply[1])
+        except (EOFError, RuntimeError):
+            self.close()
+            raise
+        finally:
+            # Every worker has mapped the block by now (or failed), so the name can go; the
+            # memory itself lives until the last mapping is dropped, even if a process dies.
+            if self.block is not None:
+                self.block.unlink()
+
+    def scatter(self, queries, top_n, block_size=256, candidate_block_size=65536):
+        t0 = registry.enabled and time.perf_counter()
+        with self.lock:
+            for connection in self.connections:
+                connection.send(('search', queries, top_n, block_size, candidate_block_size))
+            replies = [connection.recv() for connection in self.connections]
+        for reply in replies:
+            if isinstance(reply[0], str):
+                raise RuntimeError(reply[1])
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='gather')
+
+        indices = np.concatenate([reply[0] for reply in replies], axis=1)
+        sim_scores = np.concatenate([reply[1] for reply in replies], axis=1)
+        order = top_n_indices(sim_scores, top_n)
+        if t0:
+            registry.lap(STAGE_SECONDS, t0, stage='top_k')
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(sim_scores, order, axis=1)
+
+    def search(self, query, top_n, **search_params):
+        indices, sim_scores = self.scatter(query[None, :], top_n)
+        return indices[0], sim_scores[0]
+
+    def search_batch(self, queries, top_n, block_size=256, candidate_block_size=65536, **search_params):
+        if not len(queries):
             return []
-        
-    def recommend_students_to_students(self, student_id, top_n=10, threshold=0.90):
+        indices, sim_scores = self.scatter(queries, top_n, block_size, candidate_block_size)
+        return list(zip(indices, sim_scores))
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(('close',))
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
+
+    def __del__(self):
+        self.close()
+
+
+INDEX_TYPES = {'exact': ExactIndex, 'ivf': IVFIndex, 'float16': Float16Index, 'int8': Int8Index, 'pca': PCAIndex,
+               'pca-int8': PCAInt8Index}
+
+
+def index_bytes(search_index):
+    # Exact and sharded search read the normalized matrices directly and hold nothing extra.
+    return getattr(search_index, 'nbytes', 0)
+
+
+def index_path(embeddings_path, index_type):
+    return f"{os.path.splitext(embeddings_path)[0]}.{index_type}.npz"
+
+
+def build_index(embeddings_path, index_type='ivf', **build_params):
+    # Builds an approximate index from a .npy written by RecommenderDataPrep and saves it
+    # next to it, e.g. student_embeddings.npy -> student_embeddings.ivf.npz. The .npy's
+    # fingerprint is saved with it, so an index over since rewritten vectors is rebuilt.
+    source = source_fingerprint(embeddings_path)
+    with open(embeddings_path, 'rb') as f:
+        embeddings = normalize(np.load(f))
+    index = INDEX_TYPES[index_type].build(embeddings, **build_params)
+    index.save(index_path(embeddings_path, index_type), source)
+    return index
+
+
+def load_index(embeddings_path, embeddings, index_type='exact', nprobe=8, shards=None, **build_params):
+    if index_type == 'exact':
+        return ExactIndex(embeddings)
+    if index_type == 'sharded':
+        return ShardedIndex(embeddings, shards)
+
+    path = index_path(embeddings_path, index_type)
+    source = source_fingerprint(embeddings_path)
+    try:
+        return INDEX_TYPES[index_type].load(path, embeddings, nprobe, source)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Building {index_type} index for {embeddings_path}: {e}")
+        index = INDEX_TYPES[index_type].build(embeddings, nprobe=nprobe, **build_params)
+        index.save(path, source)
+        return index
+
+
+# Precomputed top-k tables written by precompute_neighbours.py, keyed by relation name.
+NEIGHBOUR_RELATIONS = {
+    'student_professor': ('student', 'professor'),
+    'professor_student': ('professor', 'student'),
+    'student_student': ('student', 'student'),
+    'professor_professor': ('professor', 'professor'),
+}
+
+
+def guids_at(guids, rows):
+    # A GuidList formats all the rows of a result at once; plain lists are indexed.
+    if hasattr(guids, 'take'):
+        return guids.take(rows)
+    return [guids[i] for i in rows]
+
+
+def guids_fingerprint(guids):
+    if hasattr(guids, 'fingerprint'):
+        return guids.fingerprint()
+    return hashlib.sha1("\n".join(guids).encode('utf-8')).hexdigest()
+
+
+def embeddings_fingerprint(embeddings_path, count, block_rows=65536):
+    # Hash of the first count rows only, so appending rows keeps it while rewriting any
+    # covered vector (the incremental reload does, under the same GUID) changes it.
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    digest = hashlib.sha1()
+    for start in range(0, min(count, len(embeddings)), block_rows):
+        digest.update(np.ascontiguousarray(embeddings[start:min(start + block_rows, count)]).tobytes())
+    return digest.hexdigest()
+
+
+class NeighbourTable:
+    # Top-k neighbour indices and scores for every query row of one relation. Query rows past
+    # the end of the table fall back to live scoring; candidates appended after the table was
+    # built are scored live and merged in, so results stay exact for the covered rows. Past
+    # expires_at every lookup falls back to live scoring.
+    def __init__(self, indices, scores, candidate_embeddings, n_candidates, expires_at=float('inf')):
+        self.indices = indices
+        self.scores = scores
+        self.candidate_embeddings = candidate_embeddings
+        self.n_candidates = n_candidates
+        self.expires_at = expires_at
+        self.top_k = indices.shape[1]
+
+    def lookup(self, row, query_embedding, top_n):
+        if row >= len(self.indices) or not 0 < top_n <= self.top_k or time.time() > self.expires_at:
+            return None
+
+        indices, sim_scores = self.indices[row, :top_n], self.scores[row, :top_n]
+
+        if len(self.candidate_embeddings) > self.n_candidates:
+            tail_scores = self.candidate_embeddings[self.n_candidates:] @ query_embedding
+            sim_scores = np.concatenate([sim_scores, tail_scores])
+            indices = np.concatenate([indices, np.arange(self.n_candidates, len(self.candidate_embeddings))])
+            order = top_n_indices(sim_scores, top_n)
+            indices, sim_scores = indices[order], sim_scores[order]
+
+        return indices, sim_scores
+
+
+def neighbour_manifest_path(directory):
+    return os.path.join(directory, 'neighbours', 'manifest.json')
+
+
+def load_neighbour_tables(directory, snapshot, max_age=86400):
+    # Tables are used only while they are younger than max_age and were built over a prefix of
+    # the current GUID lists and vectors; rows appended since then are handled by NeighbourTable.
+    # The vectors are checked as well because the incremental reload rewrites them under the
+    # same GUIDs.
+    manifest_path = neighbour_manifest_path(directory)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if time.time() - manifest['built_at'] > max_age:
+        print(f"Ignoring neighbour tables in {directory}: older than {max_age} seconds")
+        return {}
+
+    for entity in ('student', 'professor'):
+        guids = getattr(snapshot, f'{entity}_guids')
+        built = manifest[f'{entity}s']
+        if len(guids) < built['count'] or guids_fingerprint(guids[:built['count']]) != built['guids_sha1']:
+            print(f"Ignoring neighbour tables in {directory}: {entity} GUIDs changed since they were built")
+            return {}
+        if built.get('embeddings_sha1') != embeddings_fingerprint(os.path.join(directory, f'{entity}_embeddings.npy'), built['count']):
+            print(f"Ignoring neighbour tables in {directory}: {entity} embeddings changed since they were built")
+            return {}
+
+    tables = {}
+    for relation, (_, candidate_entity) in NEIGHBOUR_RELATIONS.items():
+        indices = np.load(os.path.join(directory, 'neighbours', f'{relation}_indices.npy'), mmap_mode='r')
+        scores = np.load(os.path.join(directory, 'neighbours', f'{relation}_scores.npy'), mmap_mode='r')
+        tables[relation] = NeighbourTable(indices, scores, getattr(snapshot, f'normalized_{candidate_entity}_embeddings'),
+                                          manifest[f'{candidate_entity}s']['count'], manifest['built_at'] + max_age)
+    return tables
+
+
+class CandidateFilter:
+    # Restricts candidates to metadata-selected rows. Only those rows are scored, so a filter
+    # on University Field reads just the matching partitions instead of the whole matrix.
+    def __init__(self, query_metadata, candidate_metadata, fields=None, exclude_own_field=False, where=None):
+        self.query_metadata = query_metadata
+        self.candidate_metadata = candidate_metadata
+        self.exclude_own_field = exclude_own_field
+        self.base_rows = candidate_metadata.select(fields, where)
+        if self.base_rows is None:
+            self.base_rows = np.arange(len(candidate_metadata))
+        self.group_rows = {}
+
+    def group(self, row):
+        # Queries sharing a group share a candidate set; raw query vectors have no row.
+        if not self.exclude_own_field or row is None:
+            return None
+        return self.query_metadata.value(FIELD_COLUMN, row)
+
+    def rows(self, group):
+        if group is None:
+            return self.base_rows
+        if group not in self.group_rows:
+            own_field = self.candidate_metadata.partition(FIELD_COLUMN, group)
+            self.group_rows[group] = np.setdiff1d(self.base_rows, own_field, assume_unique=True)
+        return self.group_rows[group]
+
+
+def load_metadata(embeddings_path, count):
+    path = metadata_path(embeddings_path)
+    if not os.path.exists(path):
+        return None
+    metadata = MetadataColumns.load(path)
+    if len(metadata) != count:
+        print(f"Ignoring metadata {path}: {len(metadata)} rows for {count} embeddings")
+        return None
+    return metadata
+
+
+def result_bytes(results):
+    # Approximate heap size of a result list of (GUID, score) tuples, for the cache's memory bound.
+    return sys.getsizeof(results) + sum(sys.getsizeof(item) + sys.getsizeof(item[0]) + sys.getsizeof(item[1]) for item in results)
+
+
+class ResultCache:
+    # Recommendation results keyed by (relation, GUID, top_n, threshold, nprobe), bounded by
+    # entry count and approximate bytes with least-recently-used eviction and an optional TTL.
+    # Entries are only valid for the snapshot the cache is bound to: invalidate() drops them all
+    # when the engine switches snapshots, and a query that started on an older snapshot cannot
+    # put its results back.
+    def __init__(self, max_entries=100000, max_bytes=256 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self.lock:
+            results = []
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] is not None and entry[0] < now:
+                    del self.entries[key]
+                    self.bytes -= entry[2]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    results.append(list(entry[1]))
+            return results
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, keys, results, snapshot):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        entries = [(key, (expires_at, list(result), result_bytes(result))) for key, result in zip(keys, results)]
+        with self.lock:
+            if snapshot is None or snapshot is not self.snapshot:
+                return
+            for key, entry in entries:
+                previous = self.entries.pop(key, None)
+                if previous is not None:
+                    self.bytes -= previous[2]
+                self.entries[key] = entry
+                self.bytes += entry[2]
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, _, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def put(self, key, results, snapshot):
+        self.put_many([key], [results], snapshot)
+
+    def invalidate(self, snapshot):
+        with self.lock:
+            self.snapshot = snapshot
+            self.entries.clear()
+            self.bytes = 0
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations, 'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class EngineSnapshot:
+    # Everything a query reads. The engine holds one snapshot and replaces it wholesale on
+    # refresh, so a query that has already picked it up finishes against consistent data.
+    def __init__(self, student_embeddings_path, professor_embeddings_path,
+                 student_guids_path, professor_guids_path, index_type='exact', nprobe=8, storage='memory',
+                 neighbour_tables=True, max_table_age=86400, shards=None, version=None):
+        self.version = version
+        # Replaced by the manifest's created_at when the snapshot comes from a snapshot root.
+        self.created_at = os.path.getmtime(student_embeddings_path) if os.path.exists(student_embeddings_path) else time.time()
+
         try:
-            student_index = self.student_guids.index(student_id)
-            student_embedding = self.student_embeddings[student_index].reshape(1, -1)
-
-            sim_scores = cosine_similarity(student_embedding, self.student_embeddings)
-            
-            indices = np.argsort(sim_scores[0])[-top_n:][::-1]
-            
-            mask = sim_scores[0, indices] > threshold
-            filtered_indices = indices[mask]
-            
-            recommended_students = [(self.student_guids[i], sim_scores[0, i]*100) for i in filtered_indices]
-            
-            return recommended_students
-        except ValueError as e:
+            if storage == 'mmap':
+                # Raw and pre-normalized matrices are mapped read-only from the embedding
+                # store, so serving workers share one copy through the page cache.
+                self.student_embeddings, self.normalized_student_embeddings = load_embedding_store(student_embeddings_path)
+                self.professor_embeddings, self.normalized_professor_embeddings = load_embedding_store(professor_embeddings_path)
+            else:
+                with open(student_embeddings_path, 'rb') as f:
+                    self.student_embeddings = np.load(f)
+
+                with open(professor_embeddings_path, 'rb') as f:
+                    self.professor_embeddings = np.load(f)
+
+                # Cosine similarity between unit vectors is a plain dot product, so both
+                # matrices are normalized once here instead of on every query.
+                self.normalized_student_embeddings = normalize(self.student_embeddings)
+                self.normalized_professor_embeddings = normalize(self.professor_embeddings)
+
+            # Memory-mapped binary GUID indexes (see embedding_store.GuidIndex) where the GUIDs
+            # are UUIDs, otherwise the JSON list and a dict.
+            self.student_guids, self.student_index = load_guids(student_guids_path)
+            self.professor_guids, self.professor_index = load_guids(professor_guids_path)
+        except FileNotFoundError as e:
             print(f"Error: {e}")
-            return []
+            raise
 
-    def recommend_professors_to_professors(self, professor_id, top_n=10, threshold=0.90):
+        # A row -> GUID mismatch would silently attach every result to the wrong GUID.
+        for entity, guids_path in (('student', student_guids_path), ('professor', professor_guids_path)):
+            n_guids, n_rows = len(getattr(self, f'{entity}_guids')), len(getattr(self, f'{entity}_embeddings'))
+            if n_guids != n_rows:
+                raise ValueError(f"{guids_path} has {n_guids} GUIDs for {n_rows} {entity} embeddings")
+
+        self.student_metadata = load_metadata(student_embeddings_path, len(self.student_guids))
+        self.professor_metadata = load_metadata(professor_embeddings_path, len(self.professor_guids))
+
+        self.student_search_index = load_index(student_embeddings_path, self.normalized_student_embeddings, index_type, nprobe, shards)
+        self.professor_search_index = load_index(professor_embeddings_path, self.normalized_professor_embeddings, index_type, nprobe, shards)
+        if index_type == 'sharded':
+            # Queries read the shared memory copy too, so the private one can be dropped.
+            self.normalized_student_embeddings = self.student_search_index.embeddings
+            self.normalized_professor_embeddings = self.professor_search_index.embeddings
+
+        self.directory = os.path.dirname(student_embeddings_path)
+        self.neighbour_tables = {}
+        self.neighbour_manifest_mtime = None
+        if neighbour_tables:
+            self.reload_neighbour_tables(max_table_age)
+
+    def reload_neighbour_tables(self, max_table_age):
+        # Also picks up tables precomputed into the snapshot directory after it was loaded.
+        path = neighbour_manifest_path(self.directory)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if mtime == self.neighbour_manifest_mtime:
+            return False
+        self.neighbour_manifest_mtime = mtime
+        self.neighbour_tables = load_neighbour_tables(self.directory, self, max_table_age)
+        return True
+
+    def close(self):
+        # Stops shard workers now; otherwise they go when the last query holding the snapshot does.
+        for search_index in (self.student_search_index, self.professor_search_index):
+            if hasattr(search_index, 'close'):
+                search_index.close()
+
+
+class ScholarlinkRecommendationEngine:
+    def __init__(self, student_embeddings_path, professor_embeddings_path, 
+                 student_guids_path, professor_guids_path, index_type='exact', nprobe=8, storage='memory',
+                 neighbour_tables=True, max_table_age=86400, shards=None,
+                 cache_entries=100000, cache_bytes=256 * 1024 * 1024, cache_ttl=3600):
+        self.snapshot_params = {'index_type': index_type, 'nprobe': nprobe, 'storage': storage,
+                                'neighbour_tables': neighbour_tables, 'max_table_age': max_table_age, 'shards': shards}
+        self.snapshot_root = None
+        self.stop_watching = threading.Event()
+        # Unfiltered single and batch results for repeated GUIDs; cache_entries=0 turns it off.
+        self.result_cache = ResultCache(cache_entries, cache_bytes, cache_ttl) if cache_entries else None
+        self.snapshot = EngineSnapshot(student_embeddings_path, professor_embeddings_path,
+                                       student_guids_path, professor_guids_path, **self.snapshot_params)
+        self.invalidate_cache()
+        self.register_gauges()
+
+    def __getattr__(self, name):
+        # Keeps engine.student_embeddings, engine.professor_guids etc. pointing at the live snapshot.
+        if name == 'snapshot':
+            raise AttributeError(name)
+        return getattr(self.snapshot, name)
+
+    @classmethod
+    def from_snapshots(cls, snapshot_root, **kwargs):
+        directory, manifest = current_snapshot(snapshot_root)
+        engine = cls(*snapshot_paths(directory), **kwargs)
+        engine.check_manifest(engine.snapshot, manifest)
+        engine.snapshot.version = manifest['version']
+        engine.snapshot.created_at = manifest['created_at']
+        engine.snapshot_root = snapshot_root
+        return engine
+
+    def check_manifest(self, snapshot, manifest):
+        if len(snapshot.student_guids) != manifest['students'] or len(snapshot.professor_guids) != manifest['professors']:
+            raise ValueError(f"Snapshot {manifest['version']} does not match its manifest")
+
+    def refresh(self):
+        directory, manifest = current_snapshot(self.snapshot_root)
+        if manifest['version'] == self.snapshot.version:
+            if self.snapshot_params['neighbour_tables'] and self.snapshot.reload_neighbour_tables(self.snapshot_params['max_table_age']):
+                print(f"Reloaded neighbour tables for snapshot {manifest['version']}: {sorted(self.snapshot.neighbour_tables)}")
+            return False
+
+        # The new snapshot, including any approximate index, is fully built before the single
+        # assignment below; queries in flight keep the reference they started with.
+        snapshot = EngineSnapshot(*snapshot_paths(directory), version=manifest['version'], **self.snapshot_params)
+        self.check_manifest(snapshot, manifest)
+        snapshot.created_at = manifest['created_at']
+        # The cache is bound to the new snapshot first: a query still finishing on the old one
+        # can then no longer store its results, and no cached old result outlives the switch.
+        self.invalidate_cache(snapshot)
+        self.snapshot = snapshot
+        registry.inc('recommendation_snapshot_reloads_total')
+        registry.set_gauge('recommendation_snapshot_reload_lag_seconds', time.time() - manifest['created_at'])
+        print(f"Switched to snapshot {manifest['version']}")
+        return True
+
+    def watch_snapshots(self, interval=5):
+        def watch():
+            while not self.stop_watching.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing snapshot: {e}")
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        return thread
+
+    def invalidate_cache(self, snapshot=None):
+        # Any changed vector (a new snapshot, or an upserted GUID published as one) can move every
+        # cached ranking, so the whole cache goes rather than single entries.
+        if self.result_cache is not None:
+            self.result_cache.invalidate(snapshot or self.snapshot)
+
+    def close(self):
+        self.stop_watching.set()
+        self.snapshot.close()
+
+    def register_gauges(self):
+        # Read from the live snapshot at export time; the last engine created in a process owns them.
+        registry.gauge_callback('recommendation_snapshot_age_seconds', lambda: time.time() - self.snapshot.created_at)
+        registry.gauge_callback('recommendation_snapshot_version', lambda: self.snapshot.version or 0)
+        for entity in ('student', 'professor'):
+            registry.gauge_callback('recommendation_embedding_rows', lambda entity=entity: len(getattr(self.snapshot, f'{entity}_guids')),
+                                    entity=entity)
+            registry.gauge_callback('recommendation_embedding_bytes',
+                                    lambda entity=entity: getattr(self.snapshot, f'{entity}_embeddings').nbytes +
+                                    getattr(self.snapshot, f'normalized_{entity}_embeddings').nbytes, entity=entity)
+            # Memory held by the search index on top of the matrices, e.g. compressed codes.
+            registry.gauge_callback('recommendation_index_bytes',
+                                    lambda entity=entity: index_bytes(getattr(self.snapshot, f'{entity}_search_index')), entity=entity)
+        if self.result_cache is not None:
+            for name in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'expirations', 'invalidations', 'hit_rate'):
+                registry.gauge_callback(f'recommendation_cache_{name}', lambda name=name: self.result_cache.stats()[name])
+
+    def candidate_filter(self, query_metadata, candidate_metadata, fields, exclude_own_field, where):
+        if fields is None and where is None and not exclude_own_field:
+            return None
+        if candidate_metadata is None or (exclude_own_field and query_metadata is None):
+            raise ValueError("Metadata filters need the *_metadata.npz sidecars written next to the embeddings")
+        return CandidateFilter(query_metadata, candidate_metadata, fields, exclude_own_field, where)
+
+    def search(self, query_id, query_index, query_embeddings, candidate_search_index, candidate_guids, top_n, threshold, nprobe,
+               table=None, candidate_filter=None, relation=None, snapshot=None):
+        cache = self.result_cache if candidate_filter is None else None
+        if cache is not None:
+            key = (relation, query_id, top_n, threshold, nprobe)
+            results = cache.get(key)
+            if results is not None:
+                return results
+
+        t0 = first = registry.enabled and time.perf_counter()
         try:
-            professor_index = self.professor_guids.index(professor_id)
-            professor_embedding = self.professor_embeddings[professor_index].reshape(1, -1)
-            
-            sim_scores = cosine_similarity(professor_embedding, self.professor_embeddings)
-            
-            indices = np.argsort(sim_scores[0])[-top_n:][::-1]
-            
-            mask = sim_scores[0, indices] > threshold
-            filtered_indices = indices[mask]
-            
-            recommended_professors = [(self.professor_guids[i], sim_scores[0, i]*100) for i in filtered_indices]
-            
-            return recommended_professors
-        except ValueError as e:
-            print(f"Error: {e}")
+            row = query_index[query_id]
+        except KeyError:
+            print(f"Error: '{query_id}' is not in list")
+            registry.inc('recommendation_queries_total', relation=relation)
+            registry.inc('recommendation_misses_total', relation=relation)
             return []
+        query_embedding = query_embeddings[row]
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='lookup')
+
+        if candidate_filter is not None:
+            rows = candidate_filter.rows(candidate_filter.group(row))
+            match = search_rows(candidate_search_index.embeddings, rows, query_embedding, top_n)
+        else:
+            match = table.lookup(row, query_embedding, top_n) if table is not None else None
+            if t0 and table is not None:
+                t0 = registry.lap(STAGE_SECONDS, t0, stage='table')
+                registry.inc('recommendation_table_hits_total' if match is not None else 'recommendation_table_fallbacks_total',
+                             relation=relation)
+        if match is None:
+            match = candidate_search_index.search(query_embedding, top_n, nprobe=nprobe)
+        indices, sim_scores = match
+
+        if t0:
+            t0 = time.perf_counter()
+        mask = sim_scores > threshold
+
+        results = list(zip(guids_at(candidate_guids, indices[mask]), sim_scores[mask]*100))
+        if t0:
+            registry.lap(STAGE_SECONDS, t0, stage='format')
+            registry.lap('recommendation_seconds', first, relation=relation, kind='single')
+            registry.inc('recommendation_queries_total', relation=relation)
+            registry.inc('recommendation_thresholded_total', len(mask) - len(results), relation=relation)
+        if cache is not None:
+            cache.put(key, results, snapshot)
+        return results
+
+    def lookup_queries(self, queries, query_index, query_embeddings):
+        # Batch queries are either a list of GUIDs or a 2-D array of raw embeddings.
+        if isinstance(queries, np.ndarray):
+            queries = np.atleast_2d(queries)
+            return normalize(queries), np.ones(len(queries), dtype=bool), None
+
+        if hasattr(query_index, 'rows'):
+            queries = list(queries)
+            rows = query_index.rows(queries)
+            for position in np.flatnonzero(rows < 0):
+                print(f"Error: '{queries[position]}' is not in list")
+        else:
+            rows = []
+            for query_id in queries:
+                if query_id in query_index:
+                    rows.append(query_index[query_id])
+                else:
+                    print(f"Error: '{query_id}' is not in list")
+                    rows.append(-1)
+            rows = np.asarray(rows, dtype=np.int64)
+        found = rows >= 0
+        return query_embeddings[rows[found]], found, rows[found]
+
+    def search_batch(self, queries, query_index, query_embeddings, candidate_search_index, candidate_guids,
+                     top_n, threshold, block_size, candidate_block_size, nprobe, table=None, candidate_filter=None, relation=None,
+                     snapshot=None):
+        cache = self.result_cache
+        if cache is None or candidate_filter is not None or isinstance(queries, np.ndarray):
+            return self.scan_batch(queries, query_index, query_embeddings, candidate_search_index, candidate_guids, top_n, threshold,
+                                   block_size, candidate_block_size, nprobe, table, candidate_filter, relation)[0]
+
+        # Only the GUIDs missing from the cache are scanned, as one smaller batch.
+        queries = list(queries)
+        keys = [(relation, query_id, top_n, threshold, nprobe) for query_id in queries]
+        results = cache.get_many(keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            scanned, found = self.scan_batch([queries[i] for i in missing], query_index, query_embeddings, candidate_search_index,
+                                             candidate_guids, top_n, threshold, block_size, candidate_block_size, nprobe, table,
+                                             candidate_filter, relation)
+            for i, result in zip(missing, scanned):
+                results[i] = result
+            cache.put_many([keys[missing[i]] for i in np.flatnonzero(found)], [scanned[i] for i in np.flatnonzero(found)], snapshot)
+        return results
+
+    def scan_batch(self, queries, query_index, query_embeddings, candidate_search_index, candidate_guids,
+                   top_n, threshold, block_size, candidate_block_size, nprobe, table=None, candidate_filter=None, relation=None):
+        t0 = first = registry.enabled and time.perf_counter()
+        query_block, found, rows = self.lookup_queries(queries, query_index, query_embeddings)
+        results = [[] for _ in range(len(found))]
+        if t0:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='lookup')
+            registry.inc('recommendation_queries_total', len(found), relation=relation)
+            registry.inc('recommendation_misses_total', len(found) - len(query_block), relation=relation)
+
+        matches = [None] * len(query_block)
+        if candidate_filter is not None:
+            # Filtered queries are batched per candidate set (one set unless exclude_own_field).
+            groups = {}
+            for i in range(len(query_block)):
+                groups.setdefault(candidate_filter.group(rows[i] if rows is not None else None), []).append(i)
+            for group, members in groups.items():
+                group_matches = search_rows_batch(candidate_search_index.embeddings, candidate_filter.rows(group),
+                                                  query_block[members], top_n, block_size, candidate_block_size)
+                for i, match in zip(members, group_matches):
+                    matches[i] = match
+        elif table is not None and rows is not None:
+            matches = [table.lookup(row, query, top_n) for row, query in zip(rows, query_block)]
+
+        live = [i for i, match in enumerate(matches) if match is None]
+        if t0 and candidate_filter is None and table is not None and rows is not None:
+            t0 = registry.lap(STAGE_SECONDS, t0, stage='table')
+            registry.inc('recommendation_table_hits_total', len(matches) - len(live), relation=relation)
+            registry.inc('recommendation_table_fallbacks_total', len(live), relation=relation)
+        if live:
+            live_matches = candidate_search_index.search_batch(query_block[live], top_n, block_size=block_size,
+                                                               candidate_block_size=candidate_block_size, nprobe=nprobe)
+            for i, match in zip(live, live_matches):
+                matches[i] = match
+
+        if t0:
+            t0 = time.perf_counter()
+        for position, (indices, sim_scores) in zip(np.flatnonzero(found), matches):
+            mask = sim_scores > threshold
+            results[position] = list(zip(guids_at(candidate_guids, indices[mask]), sim_scores[mask]*100))
+        if t0:
+            registry.lap(STAGE_SECONDS, t0, stage='format')
+            registry.lap('recommendation_seconds', first, relation=relation, kind='batch')
+            registry.inc('recommendation_thresholded_total', sum(len(match[1]) for match in matches) - sum(map(len, results)),
+                         relation=relation)
+
+        return results, found
+
+    def recommend_professors(self, student_id, top_n=10, threshold=0.90, nprobe=None,
+                             fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search(student_id, snapshot.student_index, snapshot.normalized_student_embeddings,
+                           snapshot.professor_search_index, snapshot.professor_guids, top_n, threshold, nprobe,
+                           snapshot.neighbour_tables.get('student_professor'),
+                           self.candidate_filter(snapshot.student_metadata, snapshot.professor_metadata, fields, exclude_own_field, where),
+                           relation='student_professor', snapshot=snapshot)
+
+    def recommend_students(self, professor_id, top_n=10, threshold=0.90, nprobe=None,
+                           fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search(professor_id, snapshot.professor_index, snapshot.normalized_professor_embeddings,
+                           snapshot.student_search_index, snapshot.student_guids, top_n, threshold, nprobe,
+                           snapshot.neighbour_tables.get('professor_student'),
+                           self.candidate_filter(snapshot.professor_metadata, snapshot.student_metadata, fields, exclude_own_field, where),
+                           relation='professor_student', snapshot=snapshot)
         
+    def recommend_students_to_students(self, student_id, top_n=10, threshold=0.90, nprobe=None,
+                                       fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search(student_id, snapshot.student_index, snapshot.normalized_student_embeddings,
+                           snapshot.student_search_index, snapshot.student_guids, top_n, threshold, nprobe,
+                           snapshot.neighbour_tables.get('student_student'),
+                           self.candidate_filter(snapshot.student_metadata, snapshot.student_metadata, fields, exclude_own_field, where),
+                           relation='student_student', snapshot=snapshot)
+
+    def recommend_professors_to_professors(self, professor_id, top_n=10, threshold=0.90, nprobe=None,
+                                           fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search(professor_id, snapshot.professor_index, snapshot.normalized_professor_embeddings,
+                           snapshot.professor_search_index, snapshot.professor_guids, top_n, threshold, nprobe,
+                           snapshot.neighbour_tables.get('professor_professor'),
+                           self.candidate_filter(snapshot.professor_metadata, snapshot.professor_metadata, fields, exclude_own_field, where),
+                           relation='professor_professor', snapshot=snapshot)
+
+    # Batch variants take a list of GUIDs (or a 2-D array of raw query embeddings) and return
+    # one result list per query, matching what the single-query methods return.
+    def recommend_professors_batch(self, student_ids, top_n=10, threshold=0.90, block_size=256, candidate_block_size=65536, nprobe=None,
+                                   fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search_batch(student_ids, snapshot.student_index, snapshot.normalized_student_embeddings,
+                                 snapshot.professor_search_index, snapshot.professor_guids,
+                                 top_n, threshold, block_size, candidate_block_size, nprobe,
+                                 snapshot.neighbour_tables.get('student_professor'),
+                                 self.candidate_filter(snapshot.student_metadata, snapshot.professor_metadata, fields, exclude_own_field, where),
+                                 relation='student_professor', snapshot=snapshot)
+
+    def recommend_students_batch(self, professor_ids, top_n=10, threshold=0.90, block_size=256, candidate_block_size=65536, nprobe=None,
+                                 fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search_batch(professor_ids, snapshot.professor_index, snapshot.normalized_professor_embeddings,
+                                 snapshot.student_search_index, snapshot.student_guids,
+                                 top_n, threshold, block_size, candidate_block_size, nprobe,
+                                 snapshot.neighbour_tables.get('professor_student'),
+                                 self.candidate_filter(snapshot.professor_metadata, snapshot.student_metadata, fields, exclude_own_field, where),
+                                 relation='professor_student', snapshot=snapshot)
+
+    def recommend_students_to_students_batch(self, student_ids, top_n=10, threshold=0.90, block_size=256, candidate_block_size=65536, nprobe=None,
+                                             fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search_batch(student_ids, snapshot.student_index, snapshot.normalized_student_embeddings,
+                                 snapshot.student_search_index, snapshot.student_guids,
+                                 top_n, threshold, block_size, candidate_block_size, nprobe,
+                                 snapshot.neighbour_tables.get('student_student'),
+                                 self.candidate_filter(snapshot.student_metadata, snapshot.student_metadata, fields, exclude_own_field, where),
+                                 relation='student_student', snapshot=snapshot)
+
+    def recommend_professors_to_professors_batch(self, professor_ids, top_n=10, threshold=0.90, block_size=256, candidate_block_size=65536, nprobe=None,
+                                                 fields=None, exclude_own_field=False, where=None):
+        snapshot = self.snapshot
+        return self.search_batch(professor_ids, snapshot.professor_index, snapshot.normalized_professor_embeddings,
+                                 snapshot.professor_search_index, snapshot.professor_guids,
+                                 top_n, threshold, block_size, candidate_block_size, nprobe,
+                                 snapshot.neighbour_tables.get('professor_professor'),
+                                 self.candidate_filter(snapshot.professor_metadata, snapshot.professor_metadata, fields, exclude_own_field, where),
+                                 relation='professor_professor', snapshot=snapshot)
+
+    def match_students_to_professors(self, capacity=None, top_k=20, method='stable', reciprocal=False, threshold=None):
+        # Bulk advisor assignment over the whole snapshot (see advisor_matching.py): one
+        # (student GUID, professor GUID, score) per matched student, each professor taking at
+        # most capacity students.
+        from advisor_matching import match_students_to_professors
+        snapshot = self.snapshot
+        students, professors, scores = match_students_to_professors(snapshot.normalized_student_embeddings,
+                                                                    snapshot.normalized_professor_embeddings,
+                                                                    capacity, top_k, method, reciprocal, threshold)
+        return list(zip(guids_at(snapshot.student_guids, students), guids_at(snapshot.professor_guids, professors), scores*100))
+
 
 if __name__ == "__main__":
     start = time.time()
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from recommendation_engine import ScholarlinkRecommendationEngine, INDEX_TYPES
+from metrics import registry
+
+# URL path -> batch method on ScholarlinkRecommendationEngine
+RECOMMENDATION_TYPES = {
+    'professors': 'recommend_professors_batch',
+    'students': 'recommend_students_batch',
+    'students_to_students': 'recommend_students_to_students_batch',
+    'professors_to_professors': 'recommend_professors_to_professors_batch',
+}
+
+# URL path -> entity the query GUID is looked up in
+QUERY_ENTITIES = {
+    'professors': 'student',
+    'students': 'professor',
+    'students_to_students': 'student',
+    'professors_to_professors': 'professor',
+}
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class MicroBatcher:
+    # Collects requests for one recommendation type. The first queued request opens a window
+    # of batch_window seconds (closed early at max_batch_size); everything collected is then
+    # scored with one batch call on the worker pool and the results are handed back to each
+    # caller. The bounded queue is the backpressure point: when it is full, submit fails fast.
+    def __init__(self, engine, method, executor, max_batch_size=64, batch_window=0.002, max_queue=1024, max_inflight=4):
+        self.engine = engine
+        self.method = method
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def submit(self, guid, top_n, threshold):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((guid, top_n, threshold, future))
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.inflight.acquire()
+            loop.create_task(self.score(batch))
+
+    async def score(self, batch):
+        try:
+            # The batch methods take one top_n/threshold, so requests are grouped by them.
+            groups = {}
+            for guid, top_n, threshold, future in batch:
+                groups.setdefault((top_n, threshold), []).append((guid, future))
+
+            loop = asyncio.get_running_loop()
+            for (top_n, threshold), requests in groups.items():
+                guids = [guid for guid, _ in requests]
+                try:
+                    results = await loop.run_in_executor(
+                        self.executor, lambda: getattr(self.engine, self.method)(guids, top_n=top_n, threshold=threshold))
+                except Exception as e:
+                    results = [e] * len(requests)
+
+                for (_, future), result in zip(requests, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        finally:
+            self.inflight.release()
+
+
+class RecommendationService:
+    def __init__(self, engine, workers=4, max_batch_size=64, batch_window=0.002, max_queue=1024):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batcher_params = {'max_batch_size': max_batch_size, 'batch_window': batch_window,
+                               'max_queue': max_queue, 'max_inflight': workers}
+        self.batchers = {}
+
+    async def start(self, host='0.0.0.0', port=8000):
+        for name, method in RECOMMENDATION_TYPES.items():
+            self.batchers[name] = MicroBatcher(self.engine, method, self.executor, **self.batcher_params)
+            self.batchers[name].start()
+            registry.gauge_callback('service_queue_depth', self.batchers[name].queue.qsize, type=name)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(int(headers['content-length']))
+
+                # Errors inside a handler still get a response; only malformed requests drop the connection.
+                try:
+                    status, payload = await self.handle_request(method, target, body)
+                except Exception as e:
+                    print(f"Error handling {method} {target}: {e}")
+                    status, payload = 500, {'error': f"Internal error: {e}"}
+                # /metrics answers in the Prometheus text format, everything else in JSON.
+                if isinstance(payload, str):
+                    data, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    data, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                             f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, target, body):
+        url = urlsplit(target)
+        parts = url.path.strip('/').split('/')
+
+        if url.path == '/health':
+            cache = self.engine.result_cache
+            return 200, {'status': 'ok', 'snapshot': self.engine.snapshot.version, 'cache': cache.stats() if cache is not None else None}
+
+        if url.path == '/metrics':
+            return 200, registry.export_prometheus()
+
+        if url.path == '/profile':
+            return await self.profile(parse_qs(url.query))
+
+        if len(parts) != 2 or parts[0] != 'recommend' or parts[1] not in self.batchers:
+            return 404, {'error': f"Unknown path {url.path}", 'types': list(RECOMMENDATION_TYPES)}
+
+        # Parameters come from the query string (GET) or a JSON body (POST).
+        if method == 'GET':
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        elif method == 'POST':
+            try:
+                params = json.loads(body or b'{}')
+            except json.JSONDecodeError as e:
+                return 400, {'error': f"Invalid JSON body: {e}"}
+        else:
+            return 405, {'error': f"Method {method} not allowed"}
+
+        try:
+            guid = str(params['id'])
+            top_n = int(params.get('top_n', 10))
+            threshold = float(params.get('threshold', 0.90))
+        except (KeyError, ValueError) as e:
+            return 400, {'error': f"Expected id and optional top_n/threshold parameters: {e}"}
+
+        try:
+            future = self.batchers[parts[1]].submit(guid, top_n, threshold)
+        except asyncio.QueueFull:
+            registry.inc('service_rejected_total', type=parts[1])
+            return 503, {'error': 'Too many pending requests, retry later'}
+
+        start = time.time()
+        try:
+            recommendations = await future
+        except Exception as e:
+            registry.inc('service_errors_total', type=parts[1])
+            print(f"Error scoring {parts[1]} for {guid}: {e}")
+            return 500, {'error': f"Recommendation failed: {e}"}
+        registry.observe('service_request_seconds', time.time() - start, type=parts[1])
+        # The engine answers an unknown GUID with no matches; only then is the GUID looked up.
+        if not recommendations and guid not in getattr(self.engine.snapshot, f'{QUERY_ENTITIES[parts[1]]}_index'):
+            return 404, {'error': f"Unknown {QUERY_ENTITIES[parts[1]]} GUID {guid}"}
+        return 200, {'id': guid,
+                     'recommendations': [{'guid': match, 'score': float(score)} for match, score in recommendations],
+                     'elapsed': time.time() - start}
+
+    async def profile(self, query):
+        # Samples every thread for the requested window while the service keeps serving.
+        if registry.profiler is not None:
+            return 409, {'error': 'A profile is already being taken'}
+        try:
+            seconds = min(float(query.get('seconds', ['5'])[0]), 60)
+            interval = float(query.get('interval', ['0.005'])[0])
+        except ValueError as e:
+            return 400, {'error': f"Expected numeric seconds/interval parameters: {e}"}
+
+        registry.start_profiler(interval)
+        await asyncio.sleep(seconds)
+        profiler = registry.stop_profiler()
+        return 200, {'samples': profiler.sample_count,
+                     'top': [{'frame': frame, 'samples': count, 'share': share} for frame, count, share in profiler.top(25)],
+                     'collapsed': profiler.collapsed()}
+
+
+def load_engine(data_path, **engine_params):
+    snapshot_root = f'{data_path}/snapshots'
+    if os.path.exists(f'{snapshot_root}/CURRENT'):
+        engine = ScholarlinkRecommendationEngine.from_snapshots(snapshot_root, **engine_params)
+        engine.watch_snapshots()
+        return engine
+
+    return ScholarlinkRecommendationEngine(f'{data_path}/student_embeddings.npy', f'{data_path}/professor_embeddings.npy',
+                                           f'{data_path}/student_guids.json', f'{data_path}/professor_guids.json', **engine_params)
+
+
+async def serve(args):
+    engine_params = {'index_type': 'sharded', 'shards': args.shards} if args.shards else {'index_type': args.index_type}
+    engine = load_engine(args.data_path, **engine_params)
+    service = RecommendationService(engine, workers=args.workers, max_batch_size=args.max_batch_size,
+                                    batch_window=args.batch_window_ms / 1000, max_queue=args.max_queue)
+    server = await service.start(args.host, args.port)
+    print(f"Serving recommendations on http://{args.host}:{args.port}/recommend/<type>?id=<guid>")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scholarlink recommendation HTTP service")
+    parser.add_argument('--data-path', default='./data/recommender_data')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--batch-window-ms', type=float, default=2.0)
+    parser.add_argument('--max-queue', type=int, default=1024)
+    parser.add_argument('--index-type', default='exact', choices=list(INDEX_TYPES),
+                        help="Search index: exact, ivf, or a compressed scan (float16, int8, pca, pca-int8) with exact re-ranking")
+    parser.add_argument('--shards', type=int, default=0, help="Scatter every query over this many shard worker processes")
+    parser.add_argument('--metrics', action='store_true', help="Collect per-stage metrics, exported on GET /metrics")
+    args = parser.parse_args()
+    if args.metrics:
+        registry.enable()
+    asyncio.run(serve(args))